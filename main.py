@@ -4,13 +4,13 @@ Features:
 - Discord slash commands + message command
 - Kurdish-first AI replies (Kurmanji/Sorani autodetect with override)
 - Conversation memory per user/server with persistence (SQLite via aiosqlite)
-- OpenAI responses with streaming-style incremental edits
+- OpenAI responses streamed into incremental message edits
 - Moderation gate + safety fallback
 - Rate limiting & retries with exponential backoff
 - Structured logging
 - Config via environment variables (.env supported)
 
-Requirements (pip): python -m pip install -U discord.py aiosqlite python-dotenv openai tiktoken tenacity
+Requirements (pip): python -m pip install -U discord.py aiosqlite python-dotenv openai tiktoken
 
 Env Vars (create .env):
 DISCORD_BOT_TOKEN=...
@@ -25,28 +25,59 @@ Run: python main.py
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import contextvars
+import hashlib
+import itertools
 import json
 import logging
+import math
 import os
+import queue
+import random
 import re
+import shutil
 import signal
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+import tempfile
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import IO, Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, Union
 from pathlib import Path
 
+import aiohttp
 import aiosqlite
 import discord
 from discord import app_commands
 from discord.ext import commands
 from discord.ui import View, Button
 from dotenv import load_dotenv
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
 # OpenAI (v1+ SDK)
 try:
     from openai import AsyncOpenAI
+    import httpx
 except Exception:  # pragma: no cover
     AsyncOpenAI = None  # type: ignore
+    httpx = None  # type: ignore
+
+try:
+    from openai import DefaultAsyncHttpxClient  # keeps the SDK's default timeouts/redirects
+except Exception:  # pragma: no cover
+    DefaultAsyncHttpxClient = None  # type: ignore
+
+try:
+    import tiktoken
+except Exception:  # pragma: no cover
+    tiktoken = None  # type: ignore
+
+try:
+    import numpy as np  # speeds up the reply cache's similarity search
+except Exception:  # pragma: no cover
+    np = None  # type: ignore
 
 # -------------------- Config & Logging --------------------
 
@@ -57,8 +88,85 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 KURDISH_DIALECT = os.getenv("KURDISH_DIALECT", "auto").lower()
 MAX_HISTORY = int(os.getenv("MAX_HISTORY", "10"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))  # prompt tokens per request
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # seconds between streamed edits
+# Start the completion while moderation is still running; output is held back until it passes
+SPECULATIVE_MODERATION = os.getenv("SPECULATIVE_MODERATION", "1").lower() not in ("0", "false", "no")
+# "Ask Kurdish AI" analyses the message without the caller's history, so identical requests share one completion
+CONTEXT_MENU_STATELESS = os.getenv("CONTEXT_MENU_STATELESS", "1").lower() not in ("0", "false", "no")
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))  # seconds an idle connection stays open
+# Per-endpoint gateway limits: concurrent calls, requests/minute, tokens/minute (0 = unlimited)
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "3"))  # chat completions
+OPENAI_CHAT_RPM = int(os.getenv("OPENAI_CHAT_RPM", "500"))
+OPENAI_CHAT_TPM = int(os.getenv("OPENAI_CHAT_TPM", "200000"))
+OPENAI_REPLY_TOKEN_ESTIMATE = int(os.getenv("OPENAI_REPLY_TOKEN_ESTIMATE", "400"))  # reserved per chat call
+OPENAI_MODERATION_CONCURRENCY = int(os.getenv("OPENAI_MODERATION_CONCURRENCY", "4"))
+OPENAI_MODERATION_RPM = int(os.getenv("OPENAI_MODERATION_RPM", "500"))
+OPENAI_SPEECH_CONCURRENCY = int(os.getenv("OPENAI_SPEECH_CONCURRENCY", "3"))
+OPENAI_SPEECH_RPM = int(os.getenv("OPENAI_SPEECH_RPM", "50"))
+OPENAI_TRANSCRIPTION_CONCURRENCY = int(os.getenv("OPENAI_TRANSCRIPTION_CONCURRENCY", "3"))
+OPENAI_TRANSCRIPTION_RPM = int(os.getenv("OPENAI_TRANSCRIPTION_RPM", "50"))
+OPENAI_EMBEDDING_CONCURRENCY = int(os.getenv("OPENAI_EMBEDDING_CONCURRENCY", "4"))
+OPENAI_EMBEDDING_RPM = int(os.getenv("OPENAI_EMBEDDING_RPM", "500"))
+# Weighted fair scheduling of AI work: "guild_id:weight,..." (unlisted guilds weigh 1)
+AI_GUILD_SHARES = {
+    int(g): float(w) for g, w in re.findall(r"(\d+)\s*:\s*([\d.]+)", os.getenv("AI_GUILD_SHARES", ""))
+}
+AI_USER_MAX_INFLIGHT = int(os.getenv("AI_USER_MAX_INFLIGHT", "2"))  # concurrent AI requests per user
+# Retries: transient failures (429/5xx/timeouts) only, within a per-request deadline
+AI_REQUEST_SLO = float(os.getenv("AI_REQUEST_SLO", "90"))  # seconds a request may spend on OpenAI calls
+AI_RETRY_ATTEMPTS = int(os.getenv("AI_RETRY_ATTEMPTS", "3"))
+AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", "15"))
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))  # consecutive failures that open the circuit
+AI_BREAKER_RESET = float(os.getenv("AI_BREAKER_RESET", "30"))  # seconds before a trial call is let through
+DISCORD_FOLLOWUP_WINDOW = 15 * 60  # interaction tokens expire after 15 minutes
 OWNER_IDS = {int(x) for x in re.findall(r"\d+", os.getenv("OWNER_IDS", ""))}
 DB_PATH = os.getenv("DB_PATH", "memory.sqlite3")
+HISTORY_FLUSH_MS = int(os.getenv("HISTORY_FLUSH_MS", "500"))
+HISTORY_FLUSH_ROWS = int(os.getenv("HISTORY_FLUSH_ROWS", "64"))
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "1024"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "900"))  # seconds, 0 = no expiry
+MODERATION_CACHE_SIZE = int(os.getenv("MODERATION_CACHE_SIZE", "4096"))
+MODERATION_CACHE_TTL = float(os.getenv("MODERATION_CACHE_TTL", "86400"))  # seconds, 0 = no expiry
+MODERATION_CACHE_PERSIST = os.getenv("MODERATION_CACHE_PERSIST", "0").lower() in ("1", "true", "yes")
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "2048"))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", "0"))  # seconds, 0 = no expiry
+TRANSLATION_CACHE_PERSIST = os.getenv("TRANSLATION_CACHE_PERSIST", "0").lower() in ("1", "true", "yes")
+STT_CACHE_SIZE = int(os.getenv("STT_CACHE_SIZE", "1024"))
+STT_CACHE_TTL = float(os.getenv("STT_CACHE_TTL", "0"))  # seconds, 0 = no expiry
+STT_CACHE_PERSIST = os.getenv("STT_CACHE_PERSIST", "1").lower() in ("1", "true", "yes")
+# First-turn replies (no history) served again for the same or, with embeddings, a similar question
+REPLY_CACHE = os.getenv("REPLY_CACHE", "0").lower() in ("1", "true", "yes")
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "2000"))  # per model and dialect
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "604800"))  # seconds, 0 = no expiry
+REPLY_CACHE_EMBEDDINGS = os.getenv("REPLY_CACHE_EMBEDDINGS", "0").lower() in ("1", "true", "yes")
+REPLY_CACHE_EMBED_MODEL = os.getenv("REPLY_CACHE_EMBED_MODEL", "text-embedding-3-small")
+REPLY_CACHE_THRESHOLD = float(os.getenv("REPLY_CACHE_THRESHOLD", "0.92"))  # cosine similarity for a semantic hit
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1")
+TTS_VOICE = os.getenv("TTS_VOICE", "alloy")  # alloy, echo, fable, onyx, nova, shimmer
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "downloads/tts_cache")
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "200"))
+# "opus" (Ogg/Opus, played by passthrough without transcoding) or "mp3" (decoded to PCM by ffmpeg)
+TTS_FORMAT = os.getenv("TTS_FORMAT", "opus").lower()
+TTS_STREAM_CHUNK = int(os.getenv("TTS_STREAM_CHUNK", "4096"))  # bytes per chunk piped into ffmpeg
+TALK_MIN_SENTENCE_CHARS = int(os.getenv("TALK_MIN_SENTENCE_CHARS", "24"))  # shorter sentences are merged
+TALK_TTS_CONCURRENCY = int(os.getenv("TALK_TTS_CONCURRENCY", "3"))  # sentences synthesised in parallel
+VOICE_QUEUE_MAX = int(os.getenv("VOICE_QUEUE_MAX", "10"))  # queued playbacks per guild
+STT_MEMORY_LIMIT_MB = float(os.getenv("STT_MEMORY_LIMIT_MB", "8"))  # larger attachments go via a temp file
+# Shrink attachments with ffmpeg before upload: drop video, mono 16 kHz Opus, trim edge silence
+STT_PREPROCESS = os.getenv("STT_PREPROCESS", "1").lower() not in ("0", "false", "no")
+STT_SILENCE_THRESHOLD_DB = float(os.getenv("STT_SILENCE_THRESHOLD_DB", "-45"))
+STT_BITRATE = os.getenv("STT_BITRATE", "24k")
+# Long clips are split at silences into overlapping segments and transcribed in parallel
+STT_CHUNKING = os.getenv("STT_CHUNKING", "1").lower() not in ("0", "false", "no")
+STT_CHUNK_MIN_SECONDS = float(os.getenv("STT_CHUNK_MIN_SECONDS", "120"))  # shorter clips go single-shot
+STT_CHUNK_SECONDS = float(os.getenv("STT_CHUNK_SECONDS", "60"))
+STT_CHUNK_OVERLAP = float(os.getenv("STT_CHUNK_OVERLAP", "1.5"))
+STT_CHUNK_CONCURRENCY = int(os.getenv("STT_CHUNK_CONCURRENCY", "4"))
+VOICE_INGEST_CONCURRENCY = int(os.getenv("VOICE_INGEST_CONCURRENCY", "3"))  # parallel transcriptions
+VOICE_INGEST_QUEUE = int(os.getenv("VOICE_INGEST_QUEUE", "20"))  # waiting attachments before on_message blocks
 
 if not DISCORD_BOT_TOKEN:
     raise SystemExit("Missing DISCORD_BOT_TOKEN in env")
@@ -71,55 +179,931 @@ logging.basicConfig(
 )
 log = logging.getLogger("kurdish-bot")
 
+# -------------------- Caching --------------------
+
+T = TypeVar("T")
+
+class LRUCache:
+    """Bounded LRU mapping with an optional per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize: int, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self.data.get(key)
+        if item is not None:
+            stamp, value = item
+            if not self.ttl or time.monotonic() - stamp < self.ttl:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Any, value: Any):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = (time.monotonic(), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key: Any):
+        self.data.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+def normalize_text(text: str) -> str:
+    """Canonical form used for cache keys: NFKC, case-folded, whitespace collapsed."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key onto one in-flight task.
+
+    Waiters are shielded from each other, so one caller being cancelled
+    doesn't cancel the shared work for the rest.
+    """
+
+    def __init__(self):
+        self.inflight: Dict[Any, asyncio.Future] = {}
+        self.shared = 0
+
+    async def run(self, key: Any, factory: Callable[[], Awaitable[T]]) -> T:
+        fut = self.inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(factory())
+            self.inflight[key] = fut
+
+            def _done(f: asyncio.Future, key=key):
+                if self.inflight.get(key) is f:
+                    del self.inflight[key]
+
+            fut.add_done_callback(_done)
+        else:
+            self.shared += 1
+        return await asyncio.shield(fut)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self.inflight), "shared": self.shared}
+
+class _SharedStream:
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+class StreamFlight:
+    """SingleFlight for async iterators: identical concurrent streams share one source.
+
+    The first caller's iterator is pumped by a background task into a replay
+    buffer. Every subscriber, including late joiners, gets all items from the
+    start and then live ones as they arrive. When the last subscriber leaves
+    early, the source is cancelled.
+    """
+
+    def __init__(self):
+        self.inflight: Dict[Any, _SharedStream] = {}
+        self.shared = 0
+
+    async def _pump(self, key: Any, shared: _SharedStream, source: AsyncIterator[Any]):
+        try:
+            async for item in source:
+                shared.chunks.append(item)
+                shared.notify()
+        except asyncio.CancelledError:
+            shared.error = asyncio.CancelledError()
+        except Exception as e:
+            shared.error = e
+        finally:
+            shared.done = True
+            shared.notify()
+            if self.inflight.get(key) is shared:
+                del self.inflight[key]
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def stream(self, key: Any, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        shared = self.inflight.get(key)
+        if shared is None:
+            shared = self.inflight[key] = _SharedStream()
+            shared.task = asyncio.ensure_future(self._pump(key, shared, factory()))
+        else:
+            self.shared += 1
+        shared.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(shared.chunks):
+                    yield shared.chunks[index]
+                    index += 1
+                if shared.done:
+                    if shared.error is not None:
+                        raise shared.error
+                    return
+                await shared.changed.wait()
+        finally:
+            shared.subscribers -= 1
+            if shared.subscribers == 0 and not shared.done:
+                # Nobody is listening any more; stop paying for the completion
+                if self.inflight.get(key) is shared:
+                    del self.inflight[key]
+                shared.task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self.inflight), "shared": self.shared}
+
+_background_tasks: set = set()
+
+def spawn(coro: Awaitable[Any]) -> asyncio.Task:
+    """Run ``coro`` in the background, keeping a reference and logging failures."""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+
+    def _done(t: asyncio.Task):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            log.warning("Background task failed: %s", t.exception())
+
+    task.add_done_callback(_done)
+    return task
+
 # -------------------- Persistence Layer --------------------
 
+# One row per message; the primary key doubles as the (conversation, seq) index
+# used for tail reads and range-delete trimming.
 CREATE_TABLE_SQL = """
-CREATE TABLE IF NOT EXISTS memory (
-    guild_id    INTEGER,
-    channel_id  INTEGER,
-    user_id     INTEGER,
-    messages    TEXT,
-    PRIMARY KEY (guild_id, channel_id, user_id)
+CREATE TABLE IF NOT EXISTS memory_messages (
+    guild_id    INTEGER NOT NULL,
+    channel_id  INTEGER NOT NULL,
+    user_id     INTEGER NOT NULL,
+    seq         INTEGER NOT NULL,
+    role        TEXT NOT NULL,
+    content     TEXT NOT NULL,
+    PRIMARY KEY (guild_id, channel_id, user_id, seq)
+) WITHOUT ROWID;
+"""
+
+# Shared second tier for the in-memory caches; each cache owns one namespace.
+CREATE_CACHE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    namespace   TEXT NOT NULL,
+    key         TEXT NOT NULL,
+    value       TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+"""
+
+# Metadata index for the on-disk TTS cache; last_used drives LRU eviction
+CREATE_TTS_INDEX_SQL = """
+CREATE TABLE IF NOT EXISTS tts_cache (
+    digest      TEXT PRIMARY KEY,
+    model       TEXT NOT NULL,
+    voice       TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    created_at  REAL NOT NULL,
+    last_used   REAL NOT NULL
 );
 """
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(CREATE_TABLE_SQL)
+CREATE_REPLY_CACHE_SQL = """
+CREATE TABLE IF NOT EXISTS reply_cache (
+    model       TEXT NOT NULL,
+    dialect     TEXT NOT NULL,
+    digest      TEXT NOT NULL,
+    reply       TEXT NOT NULL,
+    embedding   BLOB,
+    embed_model TEXT,
+    created_at  REAL NOT NULL,
+    PRIMARY KEY (model, dialect, digest)
+) WITHOUT ROWID;
+"""
+
+SCHEMA_SQL = [CREATE_TABLE_SQL, CREATE_CACHE_TABLE_SQL, CREATE_TTS_INDEX_SQL, CREATE_REPLY_CACHE_SQL]
+
+# Appends after the conversation's current tail; MAX(seq) is a PK-prefix lookup.
+APPEND_MESSAGE_SQL = """
+INSERT INTO memory_messages (guild_id, channel_id, user_id, seq, role, content)
+SELECT ?, ?, ?, COALESCE(MAX(seq), 0) + 1, ?, ?
+FROM memory_messages WHERE guild_id=? AND channel_id=? AND user_id=?
+"""
+
+TRIM_MESSAGES_SQL = """
+DELETE FROM memory_messages
+WHERE guild_id=? AND channel_id=? AND user_id=? AND seq <= (
+    SELECT MAX(seq) FROM memory_messages WHERE guild_id=? AND channel_id=? AND user_id=?
+) - ?
+"""
+
+TAIL_MESSAGES_SQL = """
+SELECT role, content FROM memory_messages
+WHERE guild_id=? AND channel_id=? AND user_id=?
+ORDER BY seq DESC LIMIT ?
+"""
+
+# Applied once per connection when the store opens. WAL turns commits into log
+# appends (cheaper fsyncs) and keeps outside readers such as backups unblocked;
+# the bot's own reads share one connection, so they still queue behind writes.
+# NORMAL sync is durable enough for chat memory.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+class MemoryStore:
+    """Long-lived SQLite handle for conversation memory.
+
+    One aiosqlite connection (and its worker thread) is opened at startup and
+    reused by every request, so the per-message path never reconnects.
+    Writes are serialised with a lock so a commit from one coroutine never
+    lands in the middle of another coroutine's statement batch.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db: Optional[aiosqlite.Connection] = None
+        self.write_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.db is not None
+
+    async def open(self):
+        if self.db is not None:
+            return
+        db = await aiosqlite.connect(self.path)
+        for pragma in SQLITE_PRAGMAS:
+            await db.execute(pragma)
+        for statement in SCHEMA_SQL:
+            await db.execute(statement)
         await db.commit()
+        await migrate_legacy_memory(db)
+        await migrate_reply_cache(db)
+        self.db = db
+        log.info("Opened SQLite store at %s", self.path)
 
-async def get_history(guild_id: int, channel_id: int, user_id: int) -> List[Dict[str, str]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT messages FROM memory WHERE guild_id=? AND channel_id=? AND user_id=?",
-            (guild_id, channel_id, user_id),
-        ) as cur:
-            row = await cur.fetchone()
-            if row and row[0]:
-                try:
-                    return json.loads(row[0])
-                except Exception:
-                    return []
-            return []
-
-async def save_history(guild_id: int, channel_id: int, user_id: int, messages: List[Dict[str, str]]):
-    # Cap length
-    trimmed = messages[-MAX_HISTORY:]
-    payload = json.dumps(trimmed, ensure_ascii=False)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "REPLACE INTO memory (guild_id, channel_id, user_id, messages) VALUES (?, ?, ?, ?)",
-            (guild_id, channel_id, user_id, payload),
+    async def close(self):
+        if self.db is None:
+            return
+        db, self.db = self.db, None
+        await db.close()
+        log.info("Closed SQLite store")
+
+    def conn(self) -> aiosqlite.Connection:
+        if self.db is None:
+            raise RuntimeError("MemoryStore is not open; call init_db() first")
+        return self.db
+
+    async def fetchone(self, sql: str, params: Tuple = ()) -> Optional[Tuple]:
+        async with self.conn().execute(sql, params) as cur:
+            return await cur.fetchone()
+
+    async def write(self, sql: str, params: Tuple = ()):
+        async with self.write_lock:
+            db = self.conn()
+            await db.execute(sql, params)
+            await db.commit()
+
+    async def fetchall(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        async with self.conn().execute(sql, params) as cur:
+            return list(await cur.fetchall())
+
+    async def write_batch(self, statements: List[Tuple[str, List[Tuple]]]):
+        """Run several executemany() calls in a single transaction."""
+        async with self.write_lock:
+            db = self.conn()
+            try:
+                for sql, rows in statements:
+                    if rows:
+                        await db.executemany(sql, rows)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+
+async def migrate_legacy_memory(db: aiosqlite.Connection):
+    """One-time import of the old JSON-blob ``memory`` table into memory_messages."""
+    async with db.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='memory'"
+    ) as cur:
+        if await cur.fetchone() is None:
+            return
+    async with db.execute("SELECT guild_id, channel_id, user_id, messages FROM memory") as cur:
+        legacy = await cur.fetchall()
+    rows = []
+    for guild_id, channel_id, user_id, payload in legacy:
+        try:
+            messages = json.loads(payload) if payload else []
+        except Exception:
+            log.warning("Skipping unreadable legacy history for %s/%s/%s", guild_id, channel_id, user_id)
+            continue
+        for seq, msg in enumerate(messages[-MAX_HISTORY:], start=1):
+            rows.append((guild_id, channel_id, user_id, seq, msg.get("role", "user"), msg.get("content", "")))
+    try:
+        await db.execute("DELETE FROM memory_messages")
+        await db.executemany(
+            "INSERT INTO memory_messages (guild_id, channel_id, user_id, seq, role, content) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
         )
+        await db.execute("DROP TABLE memory")
         await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    log.info("Migrated %d legacy conversations (%d messages) to memory_messages", len(legacy), len(rows))
 
-async def clear_history(guild_id: int, channel_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "DELETE FROM memory WHERE guild_id=? AND channel_id=? AND user_id=?",
-            (guild_id, channel_id, user_id),
+async def migrate_reply_cache(db: aiosqlite.Connection):
+    """Add the embed_model column to reply_cache tables created before it existed."""
+    async with db.execute("PRAGMA table_info(reply_cache)") as cur:
+        columns = {row[1] for row in await cur.fetchall()}
+    if "embed_model" in columns:
+        return
+    # Older rows have no recorded embedding model, so their vectors are never matched
+    await db.execute("ALTER TABLE reply_cache ADD COLUMN embed_model TEXT")
+    await db.commit()
+    log.info("Added embed_model column to reply_cache")
+
+HistoryKey = Tuple[int, int, int]  # (guild_id, channel_id, user_id)
+
+class HistoryWriter:
+    """Write-behind buffer for conversation appends with group commit.
+
+    New messages are queued per (guild, channel, user) key and flushed together
+    in a single transaction every ``interval_ms`` or as soon as ``max_rows``
+    messages are waiting, so the reply path never waits on a commit. Each
+    touched conversation is trimmed to its last ``keep`` rows with one range
+    delete. Queued messages stay readable through peek() until committed.
+    """
+
+    def __init__(self, store: MemoryStore, interval_ms: int, max_rows: int, keep: int):
+        self.store = store
+        self.interval = max(interval_ms, 1) / 1000
+        self.max_rows = max(max_rows, 1)
+        self.keep = keep
+        self.pending: Dict[HistoryKey, List[Dict[str, str]]] = {}
+        self.flushing: Dict[HistoryKey, List[Dict[str, str]]] = {}
+        self.pending_rows = 0
+        # Bumped when a flush starts and when it ends, so readers can detect any overlap
+        self.generation = 0
+        self.idle = asyncio.Event()  # clear while a flush transaction is open
+        self.idle.set()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def append(self, key: HistoryKey, messages: List[Dict[str, str]]):
+        self.pending.setdefault(key, []).extend(messages)
+        self.pending_rows += len(messages)
+        if self.pending_rows >= self.max_rows:
+            self._wake.set()
+
+    def peek(self, key: HistoryKey) -> List[Dict[str, str]]:
+        """Messages for ``key`` that are queued or mid-flush, oldest first."""
+        return self.flushing.get(key, []) + self.pending.get(key, [])
+
+    def discard(self, key: HistoryKey):
+        self.pending_rows -= len(self.pending.pop(key, []))
+        self.flushing.pop(key, None)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.exception("History flush failed: %s", e)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        self.flushing, self.pending = self.pending, {}
+        self.pending_rows = 0
+        appends = []
+        trims = []
+        for (g, c, u), msgs in self.flushing.items():
+            for msg in msgs[-self.keep:]:
+                appends.append((g, c, u, msg["role"], msg["content"], g, c, u))
+            trims.append((g, c, u, g, c, u, self.keep))
+        # Reads share the writer's connection and can see the batch before it
+        # commits, so mark the flush as running before the first statement
+        self.generation += 1
+        self.idle.clear()
+        try:
+            await self.store.write_batch([(APPEND_MESSAGE_SQL, appends), (TRIM_MESSAGES_SQL, trims)])
+        except Exception:
+            # Requeue ahead of anything appended while the flush was running
+            for key, msgs in self.flushing.items():
+                self.pending[key] = msgs + self.pending.get(key, [])
+                self.pending_rows += len(msgs)
+            raise
+        finally:
+            self.flushing = {}
+            self.generation += 1
+            self.idle.set()
+
+    async def close(self):
+        """Stop the flush loop and drain everything still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self.pending:
+            await self.flush()
+
+class PersistentCache:
+    """LRU+TTL cache with an optional SQLite second tier.
+
+    Values must be JSON-serialisable. With ``persist`` enabled, entries are
+    also written (in the background) to ``cache_entries`` under this cache's
+    namespace, so they survive restarts; LRU misses fall back to that table.
+    """
+
+    def __init__(self, store: MemoryStore, namespace: str, maxsize: int, ttl: float, persist: bool):
+        self.store = store
+        self.namespace = namespace
+        self.ttl = ttl
+        self.persist = persist
+        self.lru = LRUCache(maxsize, ttl)
+        self.db_hits = 0
+
+    async def get(self, key: str) -> Any:
+        value = self.lru.get(key)
+        if value is not None or not self.persist or not self.store.is_open:
+            return value
+        row = await self.store.fetchone(
+            "SELECT value, created_at FROM cache_entries WHERE namespace=? AND key=?", (self.namespace, key),
         )
-        await db.commit()
+        if row is None or (self.ttl and time.time() - row[1] >= self.ttl):
+            return None
+        value = json.loads(row[0])
+        self.lru.set(key, value)
+        self.db_hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        self.lru.set(key, value)
+        if self.persist and self.store.is_open:
+            spawn(self.store.write(
+                "REPLACE INTO cache_entries (namespace, key, value, created_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), time.time()),
+            ))
+
+    async def prune(self):
+        if self.persist and self.ttl:
+            await self.store.write(
+                "DELETE FROM cache_entries WHERE namespace=? AND created_at < ?",
+                (self.namespace, time.time() - self.ttl),
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.lru.stats(), "db_hits": self.db_hits}
+
+memory_store = MemoryStore(DB_PATH)
+history_writer = HistoryWriter(memory_store, HISTORY_FLUSH_MS, HISTORY_FLUSH_ROWS, MAX_HISTORY)
+# Decoded histories of recently active conversations, so the hot path skips SQLite + JSON
+history_cache = LRUCache(HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL)
+# Moderation verdicts as [flagged, categories], keyed by text_digest()
+moderation_cache = PersistentCache(
+    memory_store, "moderation", MODERATION_CACHE_SIZE, MODERATION_CACHE_TTL, MODERATION_CACHE_PERSIST,
+)
+# Translations keyed by "<dialect>:<text_digest>"
+translation_cache = PersistentCache(
+    memory_store, "translation", TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL, TRANSLATION_CACHE_PERSIST,
+)
+# Transcriptions as {"text", "language"}, keyed by sha256 of the audio bytes
+stt_cache = PersistentCache(memory_store, "transcription", STT_CACHE_SIZE, STT_CACHE_TTL, STT_CACHE_PERSIST)
+
+async def init_db():
+    await memory_store.open()
+    history_writer.start()
+    for cache in (moderation_cache, translation_cache, stt_cache):
+        await cache.prune()
+    await tts_cache.load()
+    await reply_cache.load()
+
+async def get_history(guild_id: int, channel_id: int, user_id: int) -> List[Dict[str, str]]:
+    key = (guild_id, channel_id, user_id)
+    cached = history_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    while True:
+        await history_writer.idle.wait()
+        generation = history_writer.generation
+        rows = await memory_store.fetchall(TAIL_MESSAGES_SQL, (*key, MAX_HISTORY))
+        if generation == history_writer.generation:
+            break  # no flush started or finished while we were reading
+    messages = [{"role": role, "content": content} for role, content in reversed(rows)]
+    messages = (messages + history_writer.peek(key))[-MAX_HISTORY:]
+    history_cache.set(key, messages)
+    return list(messages)
+
+async def append_history(guild_id: int, channel_id: int, user_id: int, new_messages: List[Dict[str, str]]):
+    # Only the new turn is written; history_writer batches it and trims old rows
+    key = (guild_id, channel_id, user_id)
+    cached = history_cache.get(key)
+    if cached is not None:
+        history_cache.set(key, (cached + new_messages)[-MAX_HISTORY:])
+    history_writer.append(key, new_messages)
+
+async def clear_history(guild_id: int, channel_id: int, user_id: int):
+    key = (guild_id, channel_id, user_id)
+    history_cache.pop(key)
+    history_writer.discard(key)
+    await memory_store.write(
+        "DELETE FROM memory_messages WHERE guild_id=? AND channel_id=? AND user_id=?",
+        key,
+    )
+
+# -------------------- Token Budgeting --------------------
+
+# Chat format overhead per message and for priming the assistant reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_REPLY_PRIMING = 3
+
+@lru_cache(maxsize=None)
+def get_encoder(model: str):
+    """tiktoken encoder for ``model``, built once per model name."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:  # unknown model name, or its encoding couldn't be loaded
+        pass
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # e.g. encoding file download failed
+        log.warning("No tiktoken encoding for %s, estimating token counts: %s", model, e)
+        return None
+
+@lru_cache(maxsize=8192)
+def count_tokens(model: str, text: str) -> int:
+    enc = get_encoder(model)
+    if enc is None:
+        # Rough fallback when tiktoken is unavailable; errs on the high side for Kurdish script
+        return len(text) // 2 + 1
+    return len(enc.encode(text))
+
+def message_tokens(model: str, msg: Dict[str, str]) -> int:
+    return TOKENS_PER_MESSAGE + count_tokens(model, msg.get("content", ""))
+
+def build_context(
+    model: str,
+    system_prompt: str,
+    history: List[Dict[str, str]],
+    user_input: str,
+    budget: int,
+) -> Tuple[List[Dict[str, str]], int]:
+    """Assemble chat messages within ``budget`` prompt tokens.
+
+    The system prompt and new input are always included; history is added
+    newest-first until the next message would exceed the budget. Returns the
+    messages and their prompt token count.
+    """
+    system = {"role": "system", "content": system_prompt}
+    user = {"role": "user", "content": user_input}
+    total = message_tokens(model, system) + message_tokens(model, user) + TOKENS_REPLY_PRIMING
+    kept: List[Dict[str, str]] = []
+    for msg in reversed(history):
+        cost = message_tokens(model, msg)
+        if total + cost > budget:
+            break
+        kept.append(msg)
+        total += cost
+    kept.reverse()
+    if total > budget:
+        log.warning("Prompt exceeds token budget even without history: %d > %d", total, budget)
+    return [system, *kept, user], total
+
+# -------------------- OpenAI Gateway --------------------
+
+@dataclass
+class RequestTag:
+    """Who the current task is working for; set at each command/event entry point.
+
+    ``notify`` is awaited with the queue position when a chat call has to wait;
+    ``deadline`` (time.monotonic()) bounds all OpenAI calls and retries made
+    on the request's behalf.
+    """
+    guild: int = 0
+    user: int = 0
+    notify: Optional[Callable[[int], Awaitable[Any]]] = None
+    deadline: Optional[float] = None
+
+request_tag: contextvars.ContextVar[RequestTag] = contextvars.ContextVar("request_tag", default=RequestTag())
+
+def bind_request(guild: Optional[discord.Guild], user: Optional[discord.abc.User],
+                 deadline: Optional[float] = None) -> RequestTag:
+    tag = RequestTag(guild.id if guild else 0, user.id if user else 0, deadline=deadline)
+    request_tag.set(tag)
+    return tag
+
+def interaction_deadline(interaction: discord.Interaction) -> float:
+    """Our SLO, cut short so followups still land inside Discord's 15-minute token window."""
+    age = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    window = DISCORD_FOLLOWUP_WINDOW - age - 30  # leave time to send the error message
+    return time.monotonic() + max(0.0, min(AI_REQUEST_SLO, window))
+
+class AIBusy(Exception):
+    """The user already has AI_USER_MAX_INFLIGHT requests running."""
+
+def _header_delay(err: BaseException) -> Optional[float]:
+    """Retry-After (or OpenAI's retry-after-ms) from an API error's response, in seconds."""
+    headers = getattr(getattr(err, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Seconds to back off if ``exc`` (or its cause) is an HTTP 429, else None."""
+    for err in (exc, exc.__cause__):
+        if getattr(err, "status_code", None) == 429:
+            delay = _header_delay(err)
+            return 1.0 if delay is None else delay
+    return None
+
+class TokenBucket:
+    """Refills ``per_minute`` units evenly over a minute; ``take`` waits for enough."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, amount: float = 1):
+        if self.capacity <= 0:
+            # Unlimited, but a server-requested back-off still applies
+            pause = self.blocked_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            pause = self.blocked_until - time.monotonic()
+            if pause <= 0:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                pause = (amount - self.tokens) / self.rate
+            await asyncio.sleep(pause)
+
+    def block(self, seconds: float):
+        """Stop handing out tokens for ``seconds`` (server told us to back off)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+class EndpointLimiter:
+    """Concurrency slots for one endpoint class, shared out by weighted fair queuing.
+
+    Waiters are grouped by guild, then by user. A freed slot goes to the guild
+    with the least service so far relative to its share (AI_GUILD_SHARES), and
+    within that guild round-robin across users, so a quiet guild's request is
+    served next no matter how deep the busiest guild's backlog is.
+    """
+
+    def __init__(self, name: str, concurrency: int, rpm: int = 0, tpm: int = 0,
+                 shares: Optional[Dict[int, float]] = None, announce: bool = False):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.shares = shares or {}
+        self.announce = announce  # tell the requester their position when queued
+        self.active = 0
+        self.waiters: Dict[int, "OrderedDict[int, deque[asyncio.Future]]"] = {}
+        self.vtime: Dict[int, float] = {}  # per-guild virtual service time
+        self.vclock = 0.0
+        self.calls = 0
+        self.queued_calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.peak_queue = 0
+        self.throttled = 0
+
+    def share(self, guild: int) -> float:
+        return max(self.shares.get(guild, 1.0), 0.01)
+
+    def queue_depth(self) -> int:
+        return sum(len(q) for users in self.waiters.values() for q in users.values())
+
+    def position(self, tag: RequestTag) -> int:
+        """Estimated 1-based service position of the newest waiter from ``tag``."""
+        users = self.waiters.get(tag.guild, {})
+        own = len(users.get(tag.user, ()))
+        rank = sum(min(len(q), own) for q in users.values())
+        ahead = 0
+        for guild, other in self.waiters.items():
+            if guild != tag.guild:
+                turns = -(-rank * self.share(guild) // self.share(tag.guild))  # ceil
+                ahead += min(sum(len(q) for q in other.values()), int(turns))
+        return rank + ahead
+
+    def _enqueue(self, tag: RequestTag, fut: asyncio.Future):
+        users = self.waiters.get(tag.guild)
+        if users is None:
+            # A guild that was idle rejoins at the current clock, without banked credit
+            self.vtime[tag.guild] = max(self.vtime.get(tag.guild, 0.0), self.vclock)
+            users = self.waiters[tag.guild] = OrderedDict()
+        users.setdefault(tag.user, deque()).append(fut)
+
+    def _discard(self, tag: RequestTag, fut: asyncio.Future):
+        users = self.waiters.get(tag.guild)
+        waiting = users.get(tag.user) if users else None
+        if waiting and fut in waiting:
+            waiting.remove(fut)
+            if not waiting:
+                del users[tag.user]
+            if not users:
+                del self.waiters[tag.guild]
+
+    async def acquire(self, tag: RequestTag, tokens: int = 0):
+        started = time.monotonic()
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._enqueue(tag, fut)
+            self.peak_queue = max(self.peak_queue, self.queue_depth())
+            if self.announce and tag.notify is not None:
+                spawn(tag.notify(self.position(tag)))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self.release()  # the slot was handed over just as we were cancelled
+                else:
+                    self._discard(tag, fut)
+                raise
+            self.queued_calls += 1
+        try:
+            await self.requests.take(1)
+            await self.tokens.take(tokens)
+        except BaseException:
+            self.release()
+            raise
+        waited = time.monotonic() - started
+        self.calls += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def release(self):
+        while self.waiters:
+            guild = min(self.waiters, key=self.vtime.__getitem__)
+            users = self.waiters[guild]
+            user, waiting = next(iter(users.items()))
+            fut = waiting.popleft()
+            if waiting:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if not users:
+                del self.waiters[guild]
+            if fut.done():
+                continue
+            self.vclock = self.vtime[guild]
+            self.vtime[guild] += 1.0 / self.share(guild)
+            fut.set_result(None)  # the slot passes straight to the chosen waiter
+            return
+        self.active -= 1
+
+    def throttle(self, seconds: float):
+        self.throttled += 1
+        self.requests.block(seconds)
+        log.warning("OpenAI %s rate limited; pausing %.1fs", self.name, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": self.queue_depth(),
+            "guilds_waiting": len(self.waiters),
+            "peak_queue": self.peak_queue,
+            "calls": self.calls,
+            "waited": self.queued_calls,
+            "avg_wait_ms": round(self.total_wait / self.calls * 1000, 1) if self.calls else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "throttled": self.throttled,
+        }
+
+class UserInflightLimit:
+    """Caps how many AI requests one user may have running at once."""
+
+    def __init__(self, cap: int):
+        self.cap = cap
+        self.inflight: Dict[Tuple[int, int], int] = {}
+        self.rejected = 0
+
+    @contextlib.contextmanager
+    def hold(self):
+        tag = request_tag.get()
+        key = (tag.guild, tag.user)
+        count = self.inflight.get(key, 0)
+        if self.cap > 0 and count >= self.cap:
+            self.rejected += 1
+            raise AIBusy(count)
+        self.inflight[key] = count + 1
+        try:
+            yield
+        finally:
+            remaining = self.inflight.pop(key) - 1
+            if remaining:
+                self.inflight[key] = remaining
+
+    def stats(self) -> Dict[str, Any]:
+        return {"users": len(self.inflight), "inflight": sum(self.inflight.values()), "rejected": self.rejected}
+
+class GatewayLease:
+    """A held endpoint slot; ``release`` is idempotent and learns from 429s."""
+
+    def __init__(self, limiter: EndpointLimiter):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self, error: Optional[BaseException] = None):
+        if self.released:
+            return
+        self.released = True
+        if error is not None:
+            delay = retry_after_seconds(error)
+            if delay is not None:
+                self.limiter.throttle(delay)
+        self.limiter.release()
+
+class OpenAIGateway:
+    """Single entry point for every OpenAI call the bot makes.
+
+    Each endpoint class has its own concurrency limit plus request- and
+    token-per-minute buckets sized to the account quota, and waiting calls are
+    queued fairly per guild and user (taken from ``request_tag``).
+    """
+
+    def __init__(self, limiters: List[EndpointLimiter]):
+        self.limiters = {x.name: x for x in limiters}
+
+    async def acquire(self, endpoint: str, tokens: int = 0) -> GatewayLease:
+        limiter = self.limiters[endpoint]
+        await limiter.acquire(request_tag.get(), tokens)
+        return GatewayLease(limiter)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: x.stats() for name, x in self.limiters.items()}
+
+openai_gateway = OpenAIGateway([
+    EndpointLimiter("chat", OPENAI_CONCURRENCY, OPENAI_CHAT_RPM, OPENAI_CHAT_TPM, AI_GUILD_SHARES, announce=True),
+    EndpointLimiter("moderation", OPENAI_MODERATION_CONCURRENCY, OPENAI_MODERATION_RPM, shares=AI_GUILD_SHARES),
+    EndpointLimiter("speech", OPENAI_SPEECH_CONCURRENCY, OPENAI_SPEECH_RPM, shares=AI_GUILD_SHARES),
+    EndpointLimiter("transcription", OPENAI_TRANSCRIPTION_CONCURRENCY, OPENAI_TRANSCRIPTION_RPM, shares=AI_GUILD_SHARES),
+    EndpointLimiter("embedding", OPENAI_EMBEDDING_CONCURRENCY, OPENAI_EMBEDDING_RPM, shares=AI_GUILD_SHARES),
+])
+ai_user_limit = UserInflightLimit(AI_USER_MAX_INFLIGHT)
 
 # -------------------- OpenAI Client Helpers --------------------
 
@@ -127,6 +1111,7 @@ async def clear_history(guild_id: int, channel_id: int, user_id: int):
 class AIConfig:
     model: str
     dialect: str  # auto | kurmanji | sorani
+    context_tokens: int = CONTEXT_TOKEN_BUDGET
 
     def system_prompt(self) -> str:
         dialect_note = {
@@ -150,28 +1135,188 @@ class AIError(Exception):
 class ModerationFlag(Exception):
     pass
 
+class CircuitOpen(AIError):
+    """OpenAI is failing; calls are refused until the breaker lets a trial through."""
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+def classify_openai_error(exc: BaseException) -> Tuple[bool, Optional[float]]:
+    """(retryable, server-suggested delay) for an exception from an OpenAI call.
+
+    Timeouts, connection errors, 408/409/429 and 5xx are transient; other 4xx
+    responses (bad request, auth, not found...) will fail the same way again.
+    Errors re-raised as AIError are judged by their cause.
+    """
+    for err in (exc, exc.__cause__):
+        if err is None:
+            continue
+        if isinstance(err, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+            return True, None
+        if httpx is not None and isinstance(err, httpx.TransportError):
+            return True, None
+        if type(err).__name__ in ("APITimeoutError", "APIConnectionError"):
+            return True, None
+        status = getattr(err, "status_code", None)
+        if status is not None:
+            if status in RETRYABLE_STATUS or status >= 500:
+                return True, _header_delay(err)
+            return False, None
+    return False, None
+
+class CircuitBreaker:
+    """Fails fast after ``threshold`` consecutive transient failures.
+
+    Once ``reset_after`` seconds have passed a single trial call is let through
+    (half-open); its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, name: str, threshold: int, reset_after: float):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.trial or time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        if not self.trial and time.monotonic() - self.opened_at >= self.reset_after:
+            self.trial = True
+            return
+        self.rejected += 1
+        raise CircuitOpen(f"OpenAI {self.name} unavailable (circuit open)")
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+            if not self.trial:
+                self.trips += 1
+                log.warning("OpenAI %s circuit opened after %d failures", self.name, self.failures)
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+    def abandon_trial(self):
+        """The trial call was cancelled without an outcome; allow another one."""
+        self.trial = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "trips": self.trips, "rejected": self.rejected}
+
+openai_breakers = {name: CircuitBreaker(name, AI_BREAKER_FAILURES, AI_BREAKER_RESET) for name in openai_gateway.limiters}
+
+async def call_openai_held(endpoint: str, attempt: Callable[[], Awaitable[T]], tokens: int = 0) -> Tuple[GatewayLease, T]:
+    """Take a gateway slot and run ``attempt`` with retries on transient errors, inside the request's deadline.
+
+    Client errors are raised at once. Transient ones back off exponentially
+    with jitter (or for the server's Retry-After) as long as the next attempt
+    can still start before the deadline, and feed the endpoint's breaker.
+    Time spent queued in our own gateway is bounded by the deadline too, but
+    is never counted as an OpenAI failure. On success the slot is returned
+    still held, for streams that outlive the request.
+    """
+    breaker = openai_breakers[endpoint]
+    deadline = request_tag.get().deadline or time.monotonic() + AI_REQUEST_SLO
+    for number in itertools.count(1):
+        breaker.check()
+        trial = breaker.trial
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            lease = await asyncio.wait_for(openai_gateway.acquire(endpoint, tokens), remaining)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if trial:
+                breaker.abandon_trial()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise AIError(f"OpenAI {endpoint} deadline exceeded") from None
+        try:
+            result = await asyncio.wait_for(attempt(), max(0.0, deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            lease.release()
+            if trial:
+                breaker.abandon_trial()
+            raise
+        except Exception as e:
+            lease.release(e)
+            retryable, hint = classify_openai_error(e)
+            if not retryable:
+                breaker.record_success()  # the service answered; the request itself was bad
+                raise
+            breaker.record_failure()
+            delay = hint if hint is not None else min(AI_RETRY_MAX_DELAY, 2 ** (number - 1)) * random.uniform(0.5, 1)
+            if number >= AI_RETRY_ATTEMPTS or breaker.opened_at is not None or time.monotonic() + delay >= deadline:
+                raise
+            log.warning("OpenAI %s attempt %d failed (%s); retrying in %.1fs", endpoint, number, e, delay)
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return lease, result
+
+async def call_openai(endpoint: str, attempt: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+    """call_openai_held() for calls that are finished when ``attempt`` returns."""
+    lease, result = await call_openai_held(endpoint, attempt, tokens)
+    lease.release()
+    return result
+
+def make_openai_client(api_key: str) -> "AsyncOpenAI":
+    """AsyncOpenAI client with a connection pool sized from the OPENAI_* settings."""
+    if AsyncOpenAI is None:
+        raise RuntimeError("openai python sdk v1+ is required")
+    limits = httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+    http_client_cls = DefaultAsyncHttpxClient or httpx.AsyncClient
+    # Retries are handled by call_openai, not the SDK
+    return AsyncOpenAI(api_key=api_key, http_client=http_client_cls(limits=limits), max_retries=0)
+
+# Identical history-free prompts in flight at the same time share one completion
+chat_flight = StreamFlight()
+
 class AI:
-    def __init__(self, api_key: str, cfg: AIConfig):
+    def __init__(self, api_key: str, cfg: AIConfig, client: Optional["AsyncOpenAI"] = None):
         if AsyncOpenAI is None:
             raise RuntimeError("openai python sdk v1+ is required")
-        self.client = AsyncOpenAI(api_key=api_key)
+        self.client = client or AsyncOpenAI(api_key=api_key, max_retries=0)
         self.cfg = cfg
+        self.requests = 0
+        self.prompt_tokens = 0
 
-    @retry(
-        wait=wait_exponential(multiplier=1, min=1, max=10),
-        stop=stop_after_attempt(3),
-        retry=retry_if_exception_type((AIError, asyncio.TimeoutError)),
-        reraise=True,
-    )
     async def moderate(self, text: str) -> None:
+        digest = text_digest(text)
+        cached = await moderation_cache.get(digest)
+        if cached is not None:
+            flagged, categories = cached
+            if flagged:
+                raise ModerationFlag(categories)
+            return
         try:
             # Lightweight heuristic: use text-embedding-3-large moderation endpoint if available. Fallback to responses.
-            result = await self.client.moderations.create(
+            result = await call_openai("moderation", lambda: self.client.moderations.create(
                 model="omni-moderation-latest",
                 input=text,
-            )
+            ))
             categories = result.results[0].categories
             flagged = result.results[0].flagged
+            moderation_cache.put(digest, [flagged, str(categories)])
             if flagged:
                 raise ModerationFlag(str(categories))
         except ModerationFlag:
@@ -179,92 +1324,1191 @@ class AI:
         except Exception as e:  # Treat moderation failure as soft-allow
             log.warning("Moderation check failed: %s", e)
 
-    @retry(
-        wait=wait_exponential(multiplier=1, min=1, max=15),
-        stop=stop_after_attempt(3),
-        retry=retry_if_exception_type((AIError, asyncio.TimeoutError)),
-        reraise=True,
-    )
-    async def chat(self, history: List[Dict[str, str]], user_input: str) -> str:
-        try:
-            msgs = [{"role": "system", "content": self.cfg.system_prompt()}]
-            msgs.extend(history)
-            msgs.append({"role": "user", "content": user_input})
+    def _build_messages(self, history: List[Dict[str, str]], user_input: str) -> Tuple[List[Dict[str, str]], int]:
+        msgs, prompt_tokens = build_context(
+            self.cfg.model, self.cfg.system_prompt(), history, user_input, self.cfg.context_tokens,
+        )
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        log.info(
+            "chat prompt: %d tokens, %d/%d history messages (%s)",
+            prompt_tokens, len(msgs) - 2, len(history), self.cfg.dialect,
+        )
+        return msgs, prompt_tokens
 
-            # Stream tokens and aggregate for incremental edits
-            stream = await self.client.chat.completions.create(
+    async def _open_stream(self, msgs: List[Dict[str, str]]):
+        try:
+            return await self.client.chat.completions.create(
                 model=self.cfg.model,
                 messages=msgs,
                 stream=True,
                 temperature=0.5,
             )
-            out = []
+        except Exception as e:
+            raise AIError(str(e)) from e
+
+    @staticmethod
+    async def _iter_deltas(stream) -> AsyncIterator[str]:
+        try:
             async for chunk in stream:
+                if not chunk.choices:
+                    continue
                 delta = chunk.choices[0].delta.content or ""
                 if delta:
-                    out.append(delta)
+                    yield delta
+        except Exception as e:
+            raise AIError(str(e)) from e
+
+    async def chat_stream(self, history: List[Dict[str, str]], user_input: str) -> AsyncIterator[str]:
+        """Yield reply text deltas as the model produces them.
+
+        Opening the stream is retried like chat(); once tokens have been
+        yielded a failure is raised as AIError, since the caller has already
+        shown partial output.
+        """
+        msgs, prompt_tokens = self._build_messages(history, user_input)
+        # The chat slot is held for the whole stream, not just the request
+        lease, stream = await call_openai_held(
+            "chat", lambda: self._open_stream(msgs), prompt_tokens + OPENAI_REPLY_TOKEN_ESTIMATE,
+        )
+        try:
+            async for delta in self._iter_deltas(stream):
+                yield delta
+        finally:
+            # Release the HTTP response if the consumer stopped early
+            close = getattr(stream, "close", None)
+            if close is not None:
+                try:
+                    await close()
+                except Exception:
+                    pass
+            lease.release()
+
+    async def chat(self, history: List[Dict[str, str]], user_input: str) -> str:
+        msgs, prompt_tokens = self._build_messages(history, user_input)
+
+        async def attempt() -> str:
+            stream = await self._open_stream(msgs)
+            out = [delta async for delta in self._iter_deltas(stream)]
             return "".join(out).strip()
+
+        return await call_openai("chat", attempt, prompt_tokens + OPENAI_REPLY_TOKEN_ESTIMATE)
+
+    async def answer_stream(self, history: List[Dict[str, str]], user_input: str) -> AsyncIterator[str]:
+        """chat_stream(), answered from reply_cache for first-turn questions.
+
+        Only used without history, since a cached answer can't reflect earlier
+        turns. A fresh reply is cached only once moderation has actually
+        cleared the input.
+        """
+        if history or not REPLY_CACHE:
+            async for delta in self.chat_stream(history, user_input):
+                yield delta
+            return
+        cached, vector = await reply_cache.lookup(self.client, self.cfg.model, self.cfg.dialect, user_input)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        async for delta in self.chat_stream([], user_input):
+            parts.append(delta)
+            yield delta
+        await self.moderate(user_input)  # usually a moderation_cache hit by now
+        verdict = await moderation_cache.get(text_digest(user_input))
+        if verdict is None or verdict[0]:
+            return  # moderation was unavailable (soft-allowed); don't serve this reply to others
+        spawn(reply_cache.put(self.cfg.model, self.cfg.dialect, user_input, "".join(parts).strip(), vector))
+
+    async def chat_shared_stream(self, user_input: str) -> AsyncIterator[str]:
+        """History-free chat_stream(); concurrent identical prompts share one streamed completion."""
+        key = ("chat", self.cfg.model, self.cfg.dialect, text_digest(user_input))
+        async for delta in chat_flight.stream(key, lambda: self.chat_stream([], user_input)):
+            yield delta
+
+class AIRegistry:
+    """One AI per dialect, all sharing a single AsyncOpenAI client.
+
+    Every dialect (and therefore every translate button) reuses the same warm
+    HTTP connection pool instead of opening a new client per request.
+    """
+
+    def __init__(self, api_key: str, model: str):
+        self.api_key = api_key
+        self.model = model
+        self.client = make_openai_client(api_key)
+        self._instances: Dict[str, AI] = {}
+
+    def get(self, dialect: str) -> AI:
+        inst = self._instances.get(dialect)
+        if inst is None:
+            inst = AI(api_key=self.api_key, cfg=AIConfig(model=self.model, dialect=dialect), client=self.client)
+            self._instances[dialect] = inst
+        return inst
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": sum(i.requests for i in self._instances.values()),
+            "prompt_tokens": sum(i.prompt_tokens for i in self._instances.values()),
+        }
+
+    async def close(self):
+        await self.client.close()
+
+@dataclass
+class CachedReply:
+    reply: str
+    created_at: float
+    vector: Optional[array] = None  # unit-length float32 question embedding
+
+class ReplyCache:
+    """Answers to first-turn questions, kept per model and dialect.
+
+    The exact tier is keyed by the digest of the normalized question. With
+    embeddings enabled, a miss embeds the question and serves the closest
+    cached question's reply if its cosine similarity reaches ``threshold``.
+    Entries live in the ``reply_cache`` table and are scanned in memory,
+    with NumPy when it is installed. Stored vectors are only used when they
+    came from the current embedding model.
+    """
+
+    def __init__(self, store: MemoryStore, maxsize: int, ttl: float, embed_model: Optional[str], threshold: float):
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.entries: Dict[Tuple[str, str], "OrderedDict[str, CachedReply]"] = {}  # oldest first
+        self._matrices: Dict[Tuple[str, str], Tuple[List[str], Any]] = {}
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _fresh(self, entry: CachedReply) -> bool:
+        return self.ttl <= 0 or time.time() - entry.created_at < self.ttl
+
+    async def load(self):
+        """Load unexpired entries from the database and drop the rest."""
+        if self.ttl > 0:
+            await self.store.write("DELETE FROM reply_cache WHERE created_at < ?", (time.time() - self.ttl,))
+        rows = await self.store.fetchall(
+            "SELECT model, dialect, digest, reply, embedding, embed_model, created_at FROM reply_cache ORDER BY created_at"
+        )
+        self.entries.clear()
+        self._matrices.clear()
+        for model, dialect, digest, reply, blob, embed_model, created_at in rows:
+            vector = None
+            if blob is not None and embed_model == self.embed_model:
+                vector = array("f")
+                vector.frombytes(blob)
+            self.entries.setdefault((model, dialect), OrderedDict())[digest] = CachedReply(reply, created_at, vector)
+
+    async def embed(self, client: "AsyncOpenAI", text: str) -> Optional[array]:
+        try:
+            result = await call_openai(
+                "embedding", lambda: client.embeddings.create(model=self.embed_model, input=normalize_text(text)),
+            )
         except Exception as e:
-            raise AIError(str(e))
+            log.warning("Reply cache embedding failed: %s", e)
+            return None
+        values = result.data[0].embedding
+        norm = math.sqrt(sum(x * x for x in values)) or 1.0
+        return array("f", (x / norm for x in values))
+
+    def _index(self, partition: Tuple[str, str]) -> Tuple[List[str], Any]:
+        """Digests and vectors of one partition, as a NumPy matrix when available."""
+        index = self._matrices.get(partition)
+        if index is None:
+            entries = self.entries.get(partition, {})
+            digests = [d for d, e in entries.items() if e.vector is not None]
+            vectors = [entries[d].vector for d in digests]
+            if np is not None and vectors:
+                index = (digests, np.stack([np.frombuffer(v, dtype=np.float32) for v in vectors]))
+            else:
+                index = (digests, vectors)
+            self._matrices[partition] = index
+        return index
+
+    @staticmethod
+    def _best(matrix: Any, vector: array) -> Tuple[int, float]:
+        if np is not None:
+            scores = matrix @ np.frombuffer(vector, dtype=np.float32)
+            i = int(np.argmax(scores))
+            return i, float(scores[i])
+        scores = [sum(a * b for a, b in zip(row, vector)) for row in matrix]
+        i = max(range(len(scores)), key=scores.__getitem__)
+        return i, scores[i]
+
+    async def lookup(self, client: "AsyncOpenAI", model: str, dialect: str,
+                     question: str) -> Tuple[Optional[str], Optional[array]]:
+        """(cached reply or None, question embedding to reuse in put())."""
+        partition = (model, dialect)
+        entries = self.entries.get(partition, {})
+        entry = entries.get(text_digest(question))
+        if entry is not None and self._fresh(entry):
+            self.exact_hits += 1
+            return entry.reply, entry.vector
+        if not self.embed_model:
+            self.misses += 1
+            return None, None
+        vector = await self.embed(client, question)
+        if vector is None:
+            self.misses += 1
+            return None, None
+        digests, matrix = self._index(partition)
+        if digests:
+            i, score = await asyncio.to_thread(self._best, matrix, vector)
+            match = entries.get(digests[i])
+            if score >= self.threshold and match is not None and self._fresh(match):
+                self.semantic_hits += 1
+                log.info("Reply cache semantic hit (%.3f, %s)", score, dialect)
+                return match.reply, vector
+        self.misses += 1
+        return None, vector
+
+    async def put(self, model: str, dialect: str, question: str, reply: str, vector: Optional[array] = None):
+        if not reply:
+            return
+        partition = (model, dialect)
+        digest = text_digest(question)
+        entries = self.entries.setdefault(partition, OrderedDict())
+        entries.pop(digest, None)
+        entries[digest] = CachedReply(reply, time.time(), vector)
+        evicted = []
+        while len(entries) > self.maxsize:
+            evicted.append((model, dialect, entries.popitem(last=False)[0]))
+        self._matrices.pop(partition, None)
+        if not self.store.is_open:
+            return
+        await self.store.write_batch([
+            (
+                "REPLACE INTO reply_cache (model, dialect, digest, reply, embedding, embed_model, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(
+                    model, dialect, digest, reply,
+                    vector.tobytes() if vector is not None else None,
+                    self.embed_model if vector is not None else None,
+                    entries[digest].created_at,
+                )],
+            ),
+            ("DELETE FROM reply_cache WHERE model=? AND dialect=? AND digest=?", evicted),
+        ])
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.semantic_hits
+        total = hits + self.misses
+        return {
+            "size": sum(len(x) for x in self.entries.values()),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "semantic": bool(self.embed_model),
+        }
+
+reply_cache = ReplyCache(
+    memory_store, REPLY_CACHE_SIZE, REPLY_CACHE_TTL,
+    REPLY_CACHE_EMBED_MODEL if REPLY_CACHE_EMBEDDINGS else None, REPLY_CACHE_THRESHOLD,
+)
 
 # -------------------- Voice Processing (TTS/STT) --------------------
 
-async def ai_reply_sorani(user_text: str) -> str:
-    """Direct AI reply in Sorani only"""
-    try:
-        completion = await ai.client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "هەموو وەڵامەکانت تەنها بە کوردی سۆرانی بنوسە. هەرگیز زمانێکی تر بەکار مەهێنە."},
-                {"role": "user", "content": user_text},
-            ]
-        )
-        return completion.choices[0].message.content
-    except Exception as e:
-        log.exception("Sorani AI reply failed: %s", e)
-        raise AIError(str(e))
+async def ai_reply_sorani_stream(user_text: str) -> AsyncIterator[str]:
+    """Direct AI reply in Sorani only, yielded as text deltas.
+
+    Identical concurrent requests share one streamed completion.
+    """
+    async for delta in ai_registry.get("sorani").chat_shared_stream(user_text):
+        yield delta
+
+class TTSCache:
+    """Content-addressed on-disk cache of synthesized speech.
+
+    Files are named by sha256(model, voice, format, text) and indexed in the
+    ``tts_cache`` table. When the directory grows past ``max_bytes`` the least
+    recently played entries are deleted.
+    """
+
+    def __init__(self, store: MemoryStore, directory: str, max_bytes: int, audio_format: str):
+        self.store = store
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.extension = "ogg" if audio_format == "opus" else audio_format
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # digest -> size, oldest first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, voice: str, audio_format: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{voice}\0{audio_format}\0{text}".encode("utf-8")).hexdigest()
+
+    def path_for(self, digest: str) -> Path:
+        return self.directory / f"{digest}.{self.extension}"
+
+    async def load(self):
+        """Rebuild the in-memory LRU from the index, dropping entries whose file is gone."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        rows = await self.store.fetchall("SELECT digest, size FROM tts_cache ORDER BY last_used")
+        missing = []
+        self.entries.clear()
+        self.total_bytes = 0
+        for digest, size in rows:
+            if self.path_for(digest).exists():
+                self.entries[digest] = size
+                self.total_bytes += size
+            else:
+                missing.append((digest,))
+        if missing:
+            await self.store.write_batch([("DELETE FROM tts_cache WHERE digest=?", missing)])
+        await self._evict()
+
+    def get(self, digest: str) -> Optional[str]:
+        path = self.path_for(digest)
+        if digest in self.entries and path.exists():
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            if self.store.is_open:
+                spawn(self.store.write("UPDATE tts_cache SET last_used=? WHERE digest=?", (time.time(), digest)))
+            return str(path)
+        self.misses += 1
+        return None
+
+    async def put(self, digest: str, model: str, voice: str, data: bytes) -> str:
+        path = self.path_for(digest)
+        tmp = path.with_suffix(".part")
+
+        def _write():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+
+        await asyncio.to_thread(_write)
+        self.total_bytes += len(data) - self.entries.get(digest, 0)
+        self.entries[digest] = len(data)
+        self.entries.move_to_end(digest)
+        if self.store.is_open:
+            now = time.time()
+            await self.store.write(
+                "REPLACE INTO tts_cache (digest, model, voice, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, model, voice, len(data), now, now),
+            )
+        await self._evict()
+        return str(path)
+
+    async def _evict(self):
+        evicted = []
+        # Never evict the newest entry; it is about to be played
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            digest, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.path_for(digest).unlink(missing_ok=True)
+            evicted.append((digest,))
+        if evicted and self.store.is_open:
+            await self.store.write_batch([("DELETE FROM tts_cache WHERE digest=?", evicted)])
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "mb": round(self.total_bytes / 1_048_576, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+tts_cache = TTSCache(memory_store, TTS_CACHE_DIR, int(TTS_CACHE_MAX_MB * 1_048_576), TTS_FORMAT)
+tts_flight = SingleFlight()
+
+async def tts_sorani(text: str) -> str:
+    """Convert Sorani text to speech; returns a cached audio file path.
+
+    Repeated phrases are served from tts_cache without calling the API, and
+    concurrent requests for the same phrase share one synthesis.
+    """
+    digest = TTSCache.key(TTS_MODEL, TTS_VOICE, TTS_FORMAT, text)
+    cached = tts_cache.get(digest)
+    if cached:
+        return cached
+
+    async def synthesize() -> str:
+        try:
+            response = await call_openai("speech", lambda: ai.client.audio.speech.create(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                input=text,
+                response_format=TTS_FORMAT,
+            ))
+            return await tts_cache.put(digest, TTS_MODEL, TTS_VOICE, response.content)
+        except Exception as e:
+            log.exception("Sorani TTS generation failed: %s", e)
+            raise
+
+    return await tts_flight.run(digest, synthesize)
+
+def tts_playback_source(audio: Any, pipe: bool = False) -> discord.AudioSource:
+    """Voice source for TTS audio (a file path, or a SpeechPipe with ``pipe=True``).
+
+    Ogg/Opus is handed to discord.py as-is (ffmpeg only remuxes, no decode or
+    re-encode per stream); other formats go through the PCM transcoder.
+    """
+    if TTS_FORMAT == "opus":
+        return discord.FFmpegOpusAudio(audio, pipe=pipe, codec="copy")
+    return discord.FFmpegPCMAudio(audio, pipe=pipe)
+
+class SpeechPipe:
+    """Blocking file-like reader fed with audio chunks from the event loop.
+
+    discord.py's FFmpeg sources with ``pipe=True`` call read() from a writer
+    thread and forward the bytes to ffmpeg's stdin, so playback can begin as
+    soon as the first chunk of speech arrives.
+    """
+
+    def __init__(self):
+        self._chunks: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._buffer = b""
+        self._eof = False
+
+    def feed(self, chunk: bytes):
+        self._chunks.put(chunk)
+
+    def finish(self):
+        self._chunks.put(None)
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            if self._buffer and self._chunks.empty():
+                break  # hand over what we have instead of waiting for a full block
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+async def tts_audio_source(text: str) -> discord.AudioSource:
+    """Playable source for ``text``, streaming the speech when it isn't cached yet.
+
+    Cached audio plays from disk. Otherwise the speech response is read in
+    chunks and piped straight into ffmpeg while it downloads; the complete
+    audio is stored in tts_cache afterwards. API errors before the first byte
+    are raised to the caller.
+    """
+    digest = TTSCache.key(TTS_MODEL, TTS_VOICE, TTS_FORMAT, text)
+    cached = tts_cache.get(digest)
+    if cached:
+        return tts_playback_source(cached)
+
+    pipe = SpeechPipe()
+    opened = asyncio.get_running_loop().create_future()
+
+    async def pump():
+        chunks: List[bytes] = []
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                # Each attempt opens a fresh response; only the successful one is kept open
+                lease, response = await call_openai_held("speech", lambda: stack.enter_async_context(
+                    ai.client.audio.speech.with_streaming_response.create(
+                        model=TTS_MODEL,
+                        voice=TTS_VOICE,
+                        input=text,
+                        response_format=TTS_FORMAT,
+                    )
+                ))
+                stack.callback(lease.release)
+                opened.set_result(None)
+                async for chunk in response.iter_bytes(TTS_STREAM_CHUNK):
+                    pipe.feed(chunk)
+                    chunks.append(chunk)
+        except Exception as e:
+            if not opened.done():
+                opened.set_exception(e)
+            else:
+                log.warning("TTS stream interrupted: %s", e)
+            return
+        finally:
+            pipe.finish()
+        await tts_cache.put(digest, TTS_MODEL, TTS_VOICE, b"".join(chunks))
 
-async def tts_sorani(text: str, filename: str = "sorani_tts.mp3") -> str:
-    """Convert Sorani text to speech"""
+    spawn(pump())
     try:
-        response = await ai.client.audio.speech.create(
-            model="tts-1",  # Using correct OpenAI TTS model
-            voice="alloy",  # Available voices: alloy, echo, fable, onyx, nova, shimmer
-            input=text
-        )
-        
-        file_path = f"downloads/{filename}"
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-        return file_path
+        await opened
     except Exception as e:
         log.exception("Sorani TTS generation failed: %s", e)
         raise
+    return tts_playback_source(pipe, pipe=True)
+
+# Sentence-final punctuation for Kurmanji (Latin) and Sorani (Arabic script: ؟ and ۔),
+# optionally followed by closing quotes/brackets, and only once whitespace follows.
+SENTENCE_BOUNDARY_RE = re.compile(r"(?:[.!?؟۔…]+[\"'»”)\]]*|\n+)(?=\s)")
+
+class SentenceSplitter:
+    """Incrementally cut streamed text into sentences for TTS.
+
+    Fragments shorter than ``min_chars`` are merged with the following
+    sentence so very short TTS calls don't add gaps between segments.
+    """
+
+    def __init__(self, min_chars: int = TALK_MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, delta: str) -> List[str]:
+        self.buffer += delta
+        sentences = []
+        start = 0
+        for m in SENTENCE_BOUNDARY_RE.finditer(self.buffer):
+            if m.end() - start >= self.min_chars:
+                sentence = self.buffer[start:m.end()].strip()
+                if sentence:
+                    sentences.append(sentence)
+                start = m.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> List[str]:
+        rest, self.buffer = self.buffer.strip(), ""
+        return [rest] if rest else []
+
+talk_tts_sema = asyncio.Semaphore(TALK_TTS_CONCURRENCY)
+
+async def _synthesize_segment(sentence: str) -> str:
+    async with talk_tts_sema:
+        return await tts_sorani(sentence)
+
+def _cancel_segments(segments: "asyncio.Queue[Optional[asyncio.Task]]"):
+    while not segments.empty():
+        task = segments.get_nowait()
+        if task is not None:
+            task.cancel()
+
+async def play_source(voice_client, source: discord.AudioSource):
+    """Play ``source`` and wait until it has finished."""
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()
 
-async def tts_kurdish(text: str, filename: str = "tts.mp3") -> str:
-    """Generate Kurdish TTS audio file (legacy function)"""
-    return await tts_sorani(text, filename)
+    def after(error):
+        log_playback_error(error)
+        loop.call_soon_threadsafe(finished.set)
 
-async def stt_kurdish(file_path: str) -> str:
-    """Transcribe Kurdish audio to text"""
+    if voice_client.is_playing():
+        # Only the guild scheduler plays audio; anything else is stale
+        voice_client.stop()
+    voice_client.play(source, after=after)
+    await finished.wait()
+
+async def _play_segments(voice_client, segments: "asyncio.Queue[Optional[asyncio.Task]]", stopped: asyncio.Event):
+    """Play synthesised segments back to back, in the order they were queued."""
     try:
-        with open(file_path, "rb") as audio_file:
-            transcript = await ai.client.audio.transcriptions.create(
-                model="whisper-1",  # Using correct OpenAI Whisper model
-                file=audio_file,
-                language="ku"  # Kurdish language code
-            )
-        return transcript.text
+        while True:
+            task = await segments.get()
+            if task is None:
+                return
+            try:
+                path = await task
+            except Exception as e:
+                log.warning("Skipping talk segment: %s", e)
+                continue
+            if not voice_client.is_connected():
+                return
+            await play_source(voice_client, tts_playback_source(path))
+    finally:
+        stopped.set()
+        _cancel_segments(segments)
+
+async def talk_pipeline(scheduler: "GuildAudioScheduler", requester: str, deltas: AsyncIterator[str]) -> str:
+    """Speak a streamed reply sentence by sentence; returns the full reply text.
+
+    The reply takes its place in the guild's playback queue straight away.
+    Each completed sentence is sent to TTS while the next one is still being
+    generated, and the queued item plays the audio back to back once its turn
+    comes, so voice latency is roughly that of the first sentence.
+    """
+    segments: "asyncio.Queue[Optional[asyncio.Task]]" = asyncio.Queue()
+    stopped = asyncio.Event()  # set once the item is dropped or done playing
+
+    def drop():
+        stopped.set()
+        _cancel_segments(segments)
+
+    def speak(sentence: str):
+        # Nothing will play segments once the item is gone, so don't pay for them
+        if not stopped.is_set():
+            segments.put_nowait(asyncio.ensure_future(_synthesize_segment(sentence)))
+
+    item, _ = scheduler.submit(PlaybackItem(
+        kind="talk",
+        text="",
+        requester=requester,
+        play=lambda voice_client: _play_segments(voice_client, segments, stopped),
+        on_drop=drop,
+    ))
+    splitter = SentenceSplitter()
+    parts: List[str] = []
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            for sentence in splitter.feed(delta):
+                speak(sentence)
+        for sentence in splitter.flush():
+            speak(sentence)
+    except BaseException:
+        scheduler.cancel(item)
+        _cancel_segments(segments)
+        segments.put_nowait(None)
+        raise
+    item.text = "".join(parts).strip()
+    segments.put_nowait(None)
+    return item.text
+
+# -------------------- Voice Playback Queue --------------------
+
+PRIORITY_TALK = 0   # conversational replies jump ahead of plain /speak
+PRIORITY_SPEAK = 1
+
+class VoiceQueueFull(Exception):
+    pass
+
+@dataclass
+class PlaybackItem:
+    kind: str  # talk | speak
+    text: str
+    requester: str
+    play: Callable[[Any], Awaitable[None]]  # called with the guild's voice client
+    on_drop: Optional[Callable[[], None]] = None
+    priority: int = PRIORITY_SPEAK
+    seq: int = 0
+    dedup: bool = False  # merge with an identical queued text instead of queueing twice
+
+    def __post_init__(self):
+        if self.kind == "talk":
+            self.priority = PRIORITY_TALK
+
+class GuildAudioScheduler:
+    """Per-guild playback queue: bounded, priority-ordered FIFO.
+
+    Every voice path submits here instead of stopping whatever is playing, so
+    each synthesised reply gets played in turn. Items with ``dedup`` set are
+    merged with an identical text that is still waiting. Dropped items run
+    their ``on_drop`` hook to cancel pending synthesis.
+    """
+
+    def __init__(self, guild: discord.Guild, maxsize: int = VOICE_QUEUE_MAX):
+        self.guild = guild
+        self.maxsize = maxsize
+        self.items: List[PlaybackItem] = []
+        self.current: Optional[PlaybackItem] = None
+        self._seq = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self.played = 0
+        self.deduped = 0
+        self.dropped = 0
+
+    @property
+    def busy(self) -> bool:
+        return self.current is not None or bool(self.items)
+
+    def submit(self, item: PlaybackItem) -> Tuple[PlaybackItem, int]:
+        """Queue ``item``; returns the queued item and its 1-based position.
+
+        Position 0 means it starts playing immediately. Raises VoiceQueueFull
+        when the guild already has ``maxsize`` items waiting.
+        """
+        if item.dedup:
+            for pos, queued in enumerate(self.items, start=1):
+                if queued.dedup and queued.text == item.text:
+                    self.deduped += 1
+                    return queued, pos
+        if len(self.items) >= self.maxsize:
+            raise VoiceQueueFull()
+        starts_now = not self.busy
+        item.seq = next(self._seq)
+        self.items.append(item)
+        self.items.sort(key=lambda i: (i.priority, i.seq))
+        if self._task is None or self._task.done():
+            self._task = spawn(self._run())
+        return item, 0 if starts_now else self.items.index(item) + 1
+
+    def cancel(self, item: PlaybackItem):
+        if item in self.items:
+            self.items.remove(item)
+            self._drop(item)
+
+    def clear(self):
+        items, self.items = self.items, []
+        for item in items:
+            self._drop(item)
+
+    def _drop(self, item: PlaybackItem):
+        self.dropped += 1
+        if item.on_drop:
+            item.on_drop()
+
+    async def _run(self):
+        while self.items:
+            item = self.items.pop(0)
+            voice_client = self.guild.voice_client
+            if voice_client is None or not voice_client.is_connected():
+                self._drop(item)
+                self.clear()
+                return
+            self.current = item
+            try:
+                await item.play(voice_client)
+                self.played += 1
+            except Exception as e:
+                log.warning("Playback of queued %s failed: %s", item.kind, e)
+            finally:
+                self.current = None
+
+    def describe(self) -> List[str]:
+        lines = []
+        if self.current:
+            lines.append(f"▶️ [{self.current.kind}] {self.current.requester}: {self.current.text[:60]}")
+        for pos, item in enumerate(self.items, start=1):
+            lines.append(f"{pos}. [{item.kind}] {item.requester}: {item.text[:60]}")
+        return lines
+
+audio_schedulers: Dict[int, GuildAudioScheduler] = {}
+
+def get_audio_scheduler(guild: discord.Guild) -> GuildAudioScheduler:
+    scheduler = audio_schedulers.get(guild.id)
+    if scheduler is None:
+        scheduler = audio_schedulers[guild.id] = GuildAudioScheduler(guild)
+    return scheduler
+
+def queue_speech(guild: discord.Guild, text: str, requester: str) -> int:
+    """Queue ``text`` for TTS playback in ``guild``; returns its queue position (0 = now).
+
+    Speech that will have to wait is synthesised right away so it is ready
+    (and cached) by the time its turn comes; speech that plays immediately
+    streams straight into ffmpeg instead.
+    """
+    scheduler = get_audio_scheduler(guild)
+    prefetch: Optional[asyncio.Task] = None
+    if scheduler.busy:
+        prefetch = asyncio.ensure_future(tts_sorani(text))
+
+    async def play(voice_client):
+        if prefetch is not None:
+            source = tts_playback_source(await prefetch)
+        else:
+            source = await tts_audio_source(text)
+        await play_source(voice_client, source)
+
+    item = PlaybackItem(
+        kind="speak",
+        text=text,
+        requester=requester,
+        play=play,
+        on_drop=prefetch.cancel if prefetch else None,
+        dedup=True,
+    )
+    try:
+        queued, position = scheduler.submit(item)
+    except VoiceQueueFull:
+        if prefetch is not None:
+            prefetch.cancel()
+        raise
+    if queued is not item and prefetch is not None:
+        prefetch.cancel()
+    return position
+
+AudioInput = Union[bytes, IO[bytes]]
+
+@contextlib.asynccontextmanager
+async def attachment_audio(attachment: discord.Attachment) -> AsyncIterator[AudioInput]:
+    """Attachment contents for transcription without a shared downloads/ path.
+
+    Attachments up to STT_MEMORY_LIMIT_MB are read straight into memory;
+    larger ones are streamed in chunks to a uniquely named temp file that is
+    removed when the block exits, so concurrent uploads never collide and
+    memory use stays bounded. The file's path lets ffmpeg open it directly.
+    """
+    if attachment.size <= STT_MEMORY_LIMIT_MB * 1_048_576:
+        yield await attachment.read()
+        return
+    with tempfile.NamedTemporaryFile(prefix="stt_", suffix=Path(attachment.filename).suffix) as tmp:
+        # Attachment.save() would buffer the whole body in memory first
+        async with aiohttp.ClientSession() as session:
+            async with session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(1 << 20):
+                    await asyncio.to_thread(tmp.write, chunk)
+        tmp.flush()
+        tmp.seek(0)
+        yield tmp
+
+async def stt_kurdish_detailed(audio: AudioInput, filename: str) -> Dict[str, str]:
+    """Transcribe Kurdish audio; returns {"text", "language"}
+
+    Whisper is told the language, so "language" is always that requested
+    code rather than a detected one.
+    """
+    start_pos = None if isinstance(audio, (bytes, bytearray)) else audio.tell()
+
+    async def attempt():
+        if start_pos is not None:
+            audio.seek(start_pos)  # a retry re-uploads from the beginning
+        return await ai.client.audio.transcriptions.create(
+            model="whisper-1",  # Using correct OpenAI Whisper model
+            file=(filename, audio),  # filename tells Whisper the container format
+            language="ku",  # Kurdish language code
+        )
+
+    try:
+        transcript = await call_openai("transcription", attempt)
+        return {"text": transcript.text, "language": "ku"}
     except Exception as e:
         log.exception("STT transcription failed: %s", e)
         raise
 
+FFMPEG_BIN = shutil.which("ffmpeg")
+
+def _stt_filter() -> str:
+    # silenceremove only trims the start, so reverse, trim again and reverse back for the tail.
+    # areverse buffers the whole clip, so downmix and resample to 16 kHz mono first.
+    trim = f"silenceremove=start_periods=1:start_threshold={STT_SILENCE_THRESHOLD_DB:g}dB:start_silence=0.2"
+    return f"aresample=16000,aformat=channel_layouts=mono,{trim},areverse,{trim},areverse"
+
+def ffmpeg_input_path(audio: AudioInput) -> Optional[str]:
+    """Filesystem path of a named file input, which ffmpeg can open (and seek) itself."""
+    name = getattr(audio, "name", None)
+    return name if isinstance(name, str) and os.path.isfile(name) else None
+
+async def run_ffmpeg(args: List[str], audio: AudioInput) -> Tuple[int, bytes, str]:
+    """Run ffmpeg on ``audio``; returns (exit code, stdout, stderr).
+
+    ``args`` name the input as ``pipe:0``. Named files are passed to ffmpeg by
+    path instead, so concurrent runs never share a file position. Other inputs
+    go through stdin: file objects are streamed in chunks off the event loop
+    and rewound afterwards so the caller can reuse them.
+    """
+    is_bytes = isinstance(audio, (bytes, bytearray))
+    path = None if is_bytes else ffmpeg_input_path(audio)
+    if path is not None:
+        audio.flush()
+        args = [path if arg == "pipe:0" else arg for arg in args]
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, "-hide_banner", *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        out, err = await proc.communicate()
+        return proc.returncode, out, err.decode(errors="replace")
+    start_pos = 0 if is_bytes else audio.tell()
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_BIN, "-hide_banner", *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def feed():
+        try:
+            if is_bytes:
+                proc.stdin.write(audio)
+                await proc.stdin.drain()
+            else:
+                while chunk := await asyncio.to_thread(audio.read, 1 << 20):
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg stopped reading; its exit code tells us why
+        finally:
+            proc.stdin.close()
+
+    feeder = asyncio.ensure_future(feed())
+    out, err = await asyncio.gather(proc.stdout.read(), proc.stderr.read())
+    await feeder
+    returncode = await proc.wait()
+    if not is_bytes:
+        audio.seek(start_pos)
+    return returncode, out, err.decode(errors="replace")
+
+# MP4-family files often keep their index (moov atom) at the end, which ffmpeg can't reach through a pipe
+SEEKABLE_INPUT_SUFFIXES = {".mp4", ".m4a", ".mov", ".3gp"}
+
+@contextlib.asynccontextmanager
+async def seekable_input(audio: AudioInput, filename: str) -> AsyncIterator[AudioInput]:
+    """``audio`` as a named temp file when its container needs ffmpeg to seek."""
+    if Path(filename).suffix.lower() not in SEEKABLE_INPUT_SUFFIXES or ffmpeg_input_path(audio) is not None:
+        yield audio
+        return
+    with tempfile.NamedTemporaryFile(prefix="stt_", suffix=Path(filename).suffix) as tmp:
+        if isinstance(audio, (bytes, bytearray)):
+            await asyncio.to_thread(tmp.write, audio)
+        else:
+            start_pos = audio.tell()
+            await asyncio.to_thread(shutil.copyfileobj, audio, tmp)
+            audio.seek(start_pos)
+        tmp.flush()
+        yield tmp
+
+async def preprocess_audio(audio: AudioInput, filename: str) -> Tuple[AudioInput, str]:
+    """Shrink audio for upload: strip video, downmix to mono 16 kHz Opus, trim edge silence.
+
+    Returns the original input unchanged when preprocessing is disabled,
+    ffmpeg is missing, or the conversion fails or leaves nothing behind.
+    """
+    if not STT_PREPROCESS or FFMPEG_BIN is None:
+        return audio, filename
+    started = time.monotonic()
+    if isinstance(audio, (bytes, bytearray)):
+        original_size = len(audio)
+    else:
+        start_pos = audio.tell()
+        original_size = audio.seek(0, os.SEEK_END) - start_pos
+        audio.seek(start_pos)
+    async with seekable_input(audio, filename) as source:
+        returncode, out, err = await run_ffmpeg([
+            "-loglevel", "error",
+            "-i", "pipe:0",
+            "-vn", "-ac", "1", "-ar", "16000",
+            "-af", _stt_filter(),
+            "-c:a", "libopus", "-b:a", STT_BITRATE, "-application", "voip",
+            "-f", "ogg", "pipe:1",
+        ], source)
+    if returncode != 0 or not out:
+        log.warning("STT preprocessing skipped for %s (ffmpeg exit %s): %s", filename, returncode, err[-300:])
+        return audio, filename
+    log.info(
+        "STT preprocess %s: %d KB -> %d KB in %.2fs",
+        filename, original_size // 1024, len(out) // 1024, time.monotonic() - started,
+    )
+    return out, f"{Path(filename).stem}.ogg"
+
+async def probe_silences(audio: AudioInput) -> Tuple[float, List[float]]:
+    """Duration in seconds and the midpoints of detected silences."""
+    returncode, out, err = await run_ffmpeg([
+        "-loglevel", "info", "-nostats",
+        "-i", "pipe:0",
+        "-vn", "-af", "silencedetect=noise=-35dB:d=0.4",
+        "-progress", "pipe:1",
+        "-f", "null", "-",
+    ], audio)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg probe failed: {err[-300:]}")
+    times = [int(x) for x in re.findall(r"out_time_us=(\d+)", out.decode(errors="replace"))]
+    duration = max(times) / 1_000_000 if times else 0.0
+    starts = [float(x) for x in re.findall(r"silence_start: (-?[\d.]+)", err)]
+    ends = [float(x) for x in re.findall(r"silence_end: ([\d.]+)", err)]
+    return duration, [(a + b) / 2 for a, b in zip(starts, ends)]
+
+def plan_chunks(duration: float, silences: List[float], target: float, overlap: float) -> List[Tuple[float, float]]:
+    """Cut points near every ``target`` seconds, snapped to the closest silence.
+
+    Returns (start, end) ranges widened by ``overlap`` on both sides so words
+    at a hard cut appear whole in at least one segment.
+    """
+    cuts = [0.0]
+    while duration - cuts[-1] > target * 1.5:
+        ideal = cuts[-1] + target
+        near = [m for m in silences if abs(m - ideal) <= target * 0.25 and m > cuts[-1] + 1]
+        cuts.append(min(near, key=lambda m: abs(m - ideal)) if near else ideal)
+    cuts.append(duration)
+    return [(max(0.0, a - overlap), min(duration, b + overlap)) for a, b in zip(cuts, cuts[1:])]
+
+def _words(text: str) -> List[str]:
+    return [w.strip(".,!?؟،؛۔…\"'«»") for w in normalize_text(text).split()]
+
+def stitch_transcripts(parts: List[str], max_overlap_words: int = 25) -> str:
+    """Join segment transcripts, dropping words repeated across an overlap."""
+    merged: List[str] = []
+    for part in parts:
+        words = part.split()
+        if merged:
+            tail = _words(" ".join(merged[-max_overlap_words:]))
+            head = _words(" ".join(words[:max_overlap_words]))
+            for k in range(min(len(tail), len(head)), 0, -1):
+                if tail[-k:] == head[:k]:
+                    words = words[k:]
+                    break
+        merged.extend(words)
+    return " ".join(merged)
+
+async def stt_chunked(audio: AudioInput, filename: str, duration: float, silences: List[float]) -> Dict[str, str]:
+    """Transcribe a long clip as overlapping segments in parallel and stitch the text."""
+    spans = plan_chunks(duration, silences, STT_CHUNK_SECONDS, STT_CHUNK_OVERLAP)
+    if not isinstance(audio, (bytes, bytearray)) and ffmpeg_input_path(audio) is None:
+        # Segments are cut concurrently; an unnamed file has one shared position, so read it once
+        source = audio
+        start_pos = source.tell()
+        audio = await asyncio.to_thread(source.read)
+        source.seek(start_pos)
+    sema = asyncio.Semaphore(STT_CHUNK_CONCURRENCY)
+    started = time.monotonic()
+
+    async def transcribe_span(index: int, start: float, end: float) -> Dict[str, str]:
+        async with sema:
+            returncode, out, err = await run_ffmpeg([
+                "-loglevel", "error",
+                "-i", "pipe:0",
+                "-ss", f"{start:.2f}", "-t", f"{end - start:.2f}",
+                "-vn", "-ac", "1", "-ar", "16000",
+                "-c:a", "libopus", "-b:a", STT_BITRATE, "-application", "voip",
+                "-f", "ogg", "pipe:1",
+            ], audio)
+            if returncode != 0 or not out:
+                raise RuntimeError(f"ffmpeg segment {index} failed: {err[-300:]}")
+            return await stt_kurdish_detailed(out, f"{Path(filename).stem}_{index}.ogg")
+
+    results = await asyncio.gather(*(transcribe_span(i, a, b) for i, (a, b) in enumerate(spans)))
+    log.info(
+        "Chunked STT %s: %.0fs audio in %d segments, %.2fs",
+        filename, duration, len(spans), time.monotonic() - started,
+    )
+    return {
+        "text": stitch_transcripts([r["text"] for r in results]),
+        "language": results[0]["language"] if results else "ku",
+    }
+
+async def stt_preprocessed(audio: AudioInput, filename: str) -> Dict[str, str]:
+    """Preprocess (when enabled) and transcribe; runs inside the voice ingest pool.
+
+    Clips longer than STT_CHUNK_MIN_SECONDS are transcribed in parallel
+    segments; shorter ones (or any probe failure) use a single request.
+    """
+    audio, filename = await preprocess_audio(audio, filename)
+    if STT_CHUNKING and FFMPEG_BIN is not None:
+        try:
+            duration, silences = await probe_silences(audio)
+        except Exception as e:
+            log.warning("Audio probe failed, transcribing in one request: %s", e)
+        else:
+            if duration >= STT_CHUNK_MIN_SECONDS:
+                return await stt_chunked(audio, filename, duration, silences)
+    return await stt_kurdish_detailed(audio, filename)
+
+async def audio_digest(audio: AudioInput) -> str:
+    """sha256 of the audio bytes, hashed off the event loop."""
+    if isinstance(audio, (bytes, bytearray)):
+        return await asyncio.to_thread(lambda: hashlib.sha256(audio).hexdigest())
+
+    def _hash_file() -> str:
+        h = hashlib.sha256()
+        pos = audio.tell()
+        for chunk in iter(lambda: audio.read(1 << 20), b""):
+            h.update(chunk)
+        audio.seek(pos)
+        return h.hexdigest()
+
+    return await asyncio.to_thread(_hash_file)
+
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.m4a', '.ogg', '.webm', '.mp4')
+QUESTION_MARKERS = ['?', 'چی', 'چۆن', 'کێ', 'کوا', 'کەی', 'بۆچی']
+
+class VoiceIngestPool:
+    """Fixed set of workers that transcribe voice attachments in parallel.
+
+    Jobs wait in a bounded queue; submit() blocks while it is full, which
+    pushes back on incoming messages instead of piling up unbounded work.
+    The worker count is the STT concurrency limit.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = max(workers, 1)
+        self.queue: "asyncio.Queue[Tuple[Callable[..., Awaitable[Any]], Tuple, asyncio.Future]]" = asyncio.Queue(
+            maxsize=max(queue_size, 1),
+        )
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [spawn(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, fn: Callable[..., Awaitable[T]], *args: Any) -> "asyncio.Future[T]":
+        """Queue ``fn(*args)``; waits for queue space and returns a future for the result."""
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((fn, args, fut))
+        return fut
+
+    async def _worker(self):
+        while True:
+            fn, args, fut = await self.queue.get()
+            try:
+                if not fut.cancelled():
+                    result = await fn(*args)
+                    if not fut.done():
+                        fut.set_result(result)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self.queue.qsize(),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+voice_ingest = VoiceIngestPool(VOICE_INGEST_CONCURRENCY, VOICE_INGEST_QUEUE)
+stt_flight = SingleFlight()
+
+async def transcribe_attachment(attachment: discord.Attachment) -> str:
+    """Transcribe an attachment, reusing earlier results for identical audio.
+
+    Re-posted or forwarded voice notes hash to the same digest and are
+    answered from stt_cache without queueing; identical uploads in flight at
+    the same time share one Whisper call.
+    """
+    async with attachment_audio(attachment) as audio:
+        digest = await audio_digest(audio)
+        cached = await stt_cache.get(digest)
+        if cached is not None:
+            return cached["text"]
+
+        async def work() -> Dict[str, str]:
+            result = await (await voice_ingest.submit(stt_preprocessed, audio, attachment.filename))
+            stt_cache.put(digest, result)
+            return result
+
+        return (await stt_flight.run(digest, work))["text"]
+
+async def answer_voice_attachment(message: discord.Message, attachment: discord.Attachment) -> Tuple[str, Optional[str]]:
+    """Transcribe via the ingest pool, then answer it with the AI if it looks like a question."""
+    transcribed_text = await transcribe_attachment(attachment)
+    reply = None
+    if transcribed_text.strip() and any(word in transcribed_text.lower() for word in QUESTION_MARKERS):
+        try:
+            # Get AI response to the transcribed voice message
+            hist = await get_history(
+                message.guild.id if message.guild else 0,
+                message.channel.id,
+                message.author.id
+            )
+            reply = await ai.chat(hist, transcribed_text)
+        except Exception as e:
+            log.exception("AI response to voice message failed: %s", e)
+    return transcribed_text, reply
+
 # -------------------- UI Components --------------------
 
 class KurdishView(View):
     def __init__(self, message_content: str = ""):
         super().__init__(timeout=None)
         self.message_content = message_content
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Button callbacks run in the same task, so their OpenAI calls queue under this guild/user
+        bind_request(interaction.guild, interaction.user, interaction_deadline(interaction))
+        return True
     
     @discord.ui.button(label="🔄 Kurmancî", style=discord.ButtonStyle.secondary, custom_id="to_kurmanji")
     async def to_kurmanji(self, interaction: discord.Interaction, button: Button):
@@ -276,16 +2520,13 @@ class KurdishView(View):
             await interaction.followup.send("⚠️ پەیامێک نەدۆزرایەوە بۆ وەرگێڕان.", ephemeral=True)
             return
         
-        async with openai_sema:
-            try:
-                # Force Kurmanji translation
-                temp_ai = AI(api_key=OPENAI_API_KEY, cfg=AIConfig(model=OPENAI_MODEL, dialect="kurmanji"))
-                prompt = f"ئەم دەقە بۆ کوردیی کورمانجی وەربگێڕە:\n\n{message.content}"
-                translation = await temp_ai.chat([], prompt)
-                await interaction.followup.send(f"**Kurmancî:** {as_discord_safe(translation)}", ephemeral=True)
-            except Exception as e:
-                log.exception("Kurmanji translation failed: %s", e)
-                await interaction.followup.send("❌ وەرگێڕان سەرکەوتوو نەبوو.", ephemeral=True)
+        try:
+            # Force Kurmanji translation (cached and shared between concurrent clicks)
+            translation = await translate(message.content, "kurmanji")
+            await interaction.followup.send(f"**Kurmancî:** {as_discord_safe(translation)}", ephemeral=True)
+        except Exception as e:
+            log.exception("Kurmanji translation failed: %s", e)
+            await interaction.followup.send("❌ وەرگێڕان سەرکەوتوو نەبوو.", ephemeral=True)
     
     @discord.ui.button(label="🔄 سۆرانی", style=discord.ButtonStyle.secondary, custom_id="to_sorani")
     async def to_sorani(self, interaction: discord.Interaction, button: Button):
@@ -297,16 +2538,13 @@ class KurdishView(View):
             await interaction.followup.send("⚠️ پەیامێک نەدۆزرایەوە بۆ وەرگێڕان.", ephemeral=True)
             return
         
-        async with openai_sema:
-            try:
-                # Force Sorani translation
-                temp_ai = AI(api_key=OPENAI_API_KEY, cfg=AIConfig(model=OPENAI_MODEL, dialect="sorani"))
-                prompt = f"ئەم دەقە بۆ کوردیی سۆرانی وەربگێڕە:\n\n{message.content}"
-                translation = await temp_ai.chat([], prompt)
-                await interaction.followup.send(f"**سۆرانی:** {as_discord_safe(translation)}", ephemeral=True)
-            except Exception as e:
-                log.exception("Sorani translation failed: %s", e)
-                await interaction.followup.send("❌ وەرگێڕان سەرکەوتوو نەبوو.", ephemeral=True)
+        try:
+            # Force Sorani translation (cached and shared between concurrent clicks)
+            translation = await translate(message.content, "sorani")
+            await interaction.followup.send(f"**سۆرانی:** {as_discord_safe(translation)}", ephemeral=True)
+        except Exception as e:
+            log.exception("Sorani translation failed: %s", e)
+            await interaction.followup.send("❌ وەرگێڕان سەرکەوتوو نەبوو.", ephemeral=True)
     
     @discord.ui.button(label="🔊 Speak", style=discord.ButtonStyle.success, custom_id="speak_message")
     async def speak_message(self, interaction: discord.Interaction, button: Button):
@@ -329,31 +2567,12 @@ class KurdishView(View):
             if not voice_client:
                 voice_client = await interaction.user.voice.channel.connect()
             
-            # Generate TTS
-            import time
-            filename = f"tts_{int(time.time())}.mp3"
-            audio_path = await tts_kurdish(content, filename)
-            
-            # Play audio
-            if voice_client.is_playing():
-                voice_client.stop()
-            
-            source = discord.FFmpegPCMAudio(audio_path)
-            voice_client.play(source)
-            
-            await interaction.followup.send(f"🗣️ دەنگی کرد: {content[:100]}{'...' if len(content) > 100 else ''}", ephemeral=True)
-            
-            # Clean up audio file after playing
-            def cleanup(error):
-                if error:
-                    log.error(f"Audio playback error: {error}")
-                try:
-                    os.remove(audio_path)
-                except:
-                    pass
-            
-            source.cleanup = cleanup
+            # Queue TTS playback behind anything already playing in this guild
+            position = queue_speech(interaction.guild, content, interaction.user.display_name)
+            await interaction.followup.send(speech_status(content, position), ephemeral=True)
             
+        except VoiceQueueFull:
+            await interaction.followup.send(VOICE_QUEUE_FULL_TEXT, ephemeral=True)
         except Exception as e:
             log.exception("TTS playback failed: %s", e)
             await interaction.followup.send("❌ دەنگکردن سەرکەوتوو نەبوو.", ephemeral=True)
@@ -364,12 +2583,22 @@ intents = discord.Intents.default()
 intents.message_content = True  # needed for prefix and context menu
 intents.voice_states = True     # needed for voice channel functionality
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-ai = AI(api_key=OPENAI_API_KEY, cfg=AIConfig(model=OPENAI_MODEL, dialect=KURDISH_DIALECT))
+class GuildCommandTree(app_commands.CommandTree):
+    """Command tree that tags each interaction's task with its guild and user for the OpenAI gateway."""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        bind_request(interaction.guild, interaction.user, interaction_deadline(interaction))
+        return True
+
+bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=GuildCommandTree)
 
-# Simple in-process semaphore to throttle concurrent OpenAI calls
-OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "3"))
-openai_sema = asyncio.Semaphore(OPENAI_CONCURRENCY)
+@bot.before_invoke
+async def bind_command_guild(ctx: commands.Context):
+    bind_request(ctx.guild, ctx.author, time.monotonic() + AI_REQUEST_SLO)
+
+
+ai_registry = AIRegistry(OPENAI_API_KEY, OPENAI_MODEL)
+ai = ai_registry.get(KURDISH_DIALECT)
 
 # Create downloads directory for voice messages
 Path("downloads").mkdir(exist_ok=True)
@@ -382,6 +2611,111 @@ def as_discord_safe(text: str) -> str:
     # Trim to Discord limit
     return text[:1900]  # leave room for extras
 
+TRANSLATE_PROMPTS = {
+    "kurmanji": "ئەم دەقە بۆ کوردیی کورمانجی وەربگێڕە:\n\n{text}",
+    "sorani": "ئەم دەقە بۆ کوردیی سۆرانی وەربگێڕە:\n\n{text}",
+}
+translation_flight = SingleFlight()
+
+async def translate(text: str, dialect: str) -> str:
+    """Translate ``text`` into ``dialect``, served from cache when possible.
+
+    Concurrent clicks on the same reply share one completion via
+    translation_flight; results land in translation_cache.
+    """
+    key = f"{dialect}:{text_digest(text)}"
+    cached = await translation_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def work() -> str:
+        translation = await ai_registry.get(dialect).chat([], TRANSLATE_PROMPTS[dialect].format(text=text))
+        translation_cache.put(key, translation)
+        return translation
+
+    return await translation_flight.run(key, work)
+
+async def moderated_stream(text: str, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Pass ``deltas`` through once ``text`` has passed moderation.
+
+    In speculative mode the completion streams while moderation runs, but
+    nothing is yielded until the verdict is in; a flag closes the completion
+    and raises ModerationFlag.
+    """
+    if not SPECULATIVE_MODERATION:
+        await ai.moderate(text)
+        async for delta in deltas:
+            yield delta
+        return
+    verdict = asyncio.ensure_future(ai.moderate(text))
+    held: List[str] = []
+    try:
+        async for delta in deltas:
+            if not verdict.done():
+                held.append(delta)
+                continue
+            verdict.result()
+            if held:
+                yield "".join(held)
+                held.clear()
+            yield delta
+        await verdict
+        if held:
+            yield "".join(held)
+    finally:
+        if not verdict.done():
+            verdict.cancel()
+        await deltas.aclose()
+
+def log_playback_error(error: Optional[Exception]):
+    # voice_client.play() "after" callback; cached audio files are kept for reuse
+    if error:
+        log.error("Audio playback error: %s", error)
+
+VOICE_QUEUE_FULL_TEXT = "⏳ ڕیزی دەنگ پڕە. تکایە دواتر هەوڵ بدە."
+
+def speech_status(text: str, position: int) -> str:
+    preview = f"{text[:100]}{'...' if len(text) > 100 else ''}"
+    if position == 0:
+        return f"🗣️ دەنگی کرد: {preview}"
+    return f"📥 لە ڕیزدایە (#{position}): {preview}"
+
+AI_BUSY_TEXT = "⏳ هێشتا داواکارییەکی ترت لە کاردایە. تکایە چاوەڕێ بکە تا تەواو دەبێت."
+
+def queued_text(position: int) -> str:
+    return f"⏳ لە ڕیزدایە، شوێنی {position}…"
+
+def announce_queue(send: Callable[[str], Awaitable[Any]]) -> None:
+    """Have the gateway report this task's queue position through ``send`` instead of waiting silently."""
+    request_tag.set(replace(request_tag.get(), notify=lambda position: send(queued_text(position))))
+
+STREAM_PLACEHOLDER = "✍️ …"
+STREAM_CURSOR = " ▌"
+
+async def stream_to_message(message: discord.Message, deltas: AsyncIterator[str]) -> str:
+    """Render streamed deltas into ``message`` by editing it in place.
+
+    Edits are coalesced to at most one per STREAM_EDIT_INTERVAL so a fast
+    stream doesn't run into Discord's edit rate limit. The final edit attaches
+    the translate/speak buttons. Returns the full reply text.
+    """
+    parts: List[str] = []
+    shown = ""
+    last_edit = time.monotonic()
+    async for delta in deltas:
+        parts.append(delta)
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+        text = as_discord_safe("".join(parts).strip())
+        if text and text != shown:
+            await message.edit(content=text + STREAM_CURSOR)
+            shown = text
+            last_edit = time.monotonic()
+    reply = "".join(parts).strip()
+    await message.edit(content=as_discord_safe(reply) or "…", view=KurdishView(message_content=reply))
+    return reply
+
 async def build_history(ctx_like, new_pair: Optional[Tuple[str, str]] = None) -> List[Dict[str, str]]:
     guild_id = ctx_like.guild.id if ctx_like.guild else 0
     channel_id = ctx_like.channel.id
@@ -395,17 +2729,16 @@ async def build_history(ctx_like, new_pair: Optional[Tuple[str, str]] = None) ->
             hist.append({"role": "assistant", "content": a})
     return hist
 
-async def persist_history(ctx_like, messages: List[Dict[str, str]]):
+async def persist_history(ctx_like, new_messages: List[Dict[str, str]]):
     guild_id = ctx_like.guild.id if ctx_like.guild else 0
     channel_id = ctx_like.channel.id
     user_id = ctx_like.user.id if isinstance(ctx_like, discord.Interaction) else ctx_like.author.id
-    await save_history(guild_id, channel_id, user_id, messages)
+    await append_history(guild_id, channel_id, user_id, new_messages)
 
 # -------------------- Commands --------------------
 
 @bot.event
 async def on_ready():
-    await init_db()
     try:
         synced = await bot.tree.sync()
         log.info("Synced %d app commands", len(synced))
@@ -419,20 +2752,16 @@ async def on_message(message):
     if message.author.bot:
         await bot.process_commands(message)
         return
+    bind_request(message.guild, message.author)
     
-    # Process voice message attachments
-    if message.attachments:
-        for attachment in message.attachments:
-            # Check if it's an audio file
-            if attachment.filename.lower().endswith(('.mp3', '.wav', '.m4a', '.ogg', '.webm', '.mp4')):
+    # Process voice message attachments: transcribed in parallel, answered in upload order
+    audio_attachments = [a for a in message.attachments if a.filename.lower().endswith(AUDIO_EXTENSIONS)]
+    if audio_attachments:
+        async with message.channel.typing():
+            jobs = [asyncio.ensure_future(answer_voice_attachment(message, a)) for a in audio_attachments]
+            for job in jobs:
                 try:
-                    # Download the audio file
-                    file_path = f"downloads/{attachment.filename}"
-                    await attachment.save(file_path)
-                    
-                    # Transcribe the audio
-                    async with message.channel.typing():
-                        transcribed_text = await stt_kurdish(file_path)
+                    transcribed_text, reply = await job
                     
                     if transcribed_text.strip():
                         # Send transcription with translation buttons
@@ -446,46 +2775,28 @@ async def on_message(message):
                         
                         await message.reply(embed=embed, view=view)
                         
-                        # Optionally process as chat if it looks like a question/command
-                        if any(word in transcribed_text.lower() for word in ['?', 'چی', 'چۆن', 'کێ', 'کوا', 'کەی', 'بۆچی']):
-                            try:
-                                # Get AI response to the transcribed voice message
-                                hist = await get_history(
-                                    message.guild.id if message.guild else 0, 
-                                    message.channel.id, 
-                                    message.author.id
-                                )
-                                reply = await ai.chat(hist, transcribed_text)
-                                
-                                # Save to history
-                                hist.append({"role": "user", "content": transcribed_text})
-                                hist.append({"role": "assistant", "content": reply})
-                                await save_history(
-                                    message.guild.id if message.guild else 0, 
-                                    message.channel.id, 
-                                    message.author.id, 
-                                    hist
-                                )
-                                
-                                # Send AI response with voice and translation buttons
-                                ai_view = KurdishView(message_content=reply)
-                                ai_embed = discord.Embed(
-                                    title="🤖 Kurdish AI Response",
-                                    description=as_discord_safe(reply),
-                                    color=discord.Color.green()
-                                )
-                                await message.channel.send(embed=ai_embed, view=ai_view)
-                                
-                            except Exception as e:
-                                log.exception("AI response to voice message failed: %s", e)
+                        if reply:
+                            # Save to history
+                            await append_history(
+                                message.guild.id if message.guild else 0, 
+                                message.channel.id, 
+                                message.author.id, 
+                                [
+                                    {"role": "user", "content": transcribed_text},
+                                    {"role": "assistant", "content": reply},
+                                ]
+                            )
+                            
+                            # Send AI response with voice and translation buttons
+                            ai_view = KurdishView(message_content=reply)
+                            ai_embed = discord.Embed(
+                                title="🤖 Kurdish AI Response",
+                                description=as_discord_safe(reply),
+                                color=discord.Color.green()
+                            )
+                            await message.channel.send(embed=ai_embed, view=ai_view)
                     else:
                         await message.reply("⚠️ نەتوانرا دەنگەکە بگوێزرێتەوە بۆ نووسین.")
-                    
-                    # Clean up the downloaded file
-                    try:
-                        os.remove(file_path)
-                    except:
-                        pass
                         
                 except Exception as e:
                     log.exception("Voice message processing failed: %s", e)
@@ -500,53 +2811,71 @@ async def on_message(message):
 async def chat_command(inter: discord.Interaction, message: str):
     await inter.response.defer(thinking=True)
 
+    placeholder = None
     try:
-        await ai.moderate(message)
-    except ModerationFlag as mf:
-        await inter.followup.send("⚠️ داواکاریەکە بەهۆی یاسای پاراستن ڕەتکرایەوە.")
-        return
-
-    async with openai_sema:  # limit concurrency
-        try:
-            # Build context and get reply
+        with ai_user_limit.hold():
+            # Build context and stream the reply into a placeholder message
             hist = await get_history(inter.guild.id if inter.guild else 0, inter.channel.id, inter.user.id)
-            reply = await ai.chat(hist, message)
+            placeholder = await inter.followup.send(STREAM_PLACEHOLDER, wait=True)
+            announce_queue(lambda text: placeholder.edit(content=text))
+            reply = await stream_to_message(placeholder, moderated_stream(message, ai.answer_stream(hist, message)))
             # Save
-            hist.append({"role": "user", "content": message})
-            hist.append({"role": "assistant", "content": reply})
-            await save_history(inter.guild.id if inter.guild else 0, inter.channel.id, inter.user.id, hist)
-
-            # Send reply with translation and voice buttons
-            view = KurdishView(message_content=reply)
-            await inter.followup.send(as_discord_safe(reply), view=view)
-        except Exception as e:
-            log.exception("/chat failed: %s", e)
-            await inter.followup.send("❌ هەڵەیەک ڕوویدا. تکایە دواتر هەوڵ بدە.")
+            await append_history(
+                inter.guild.id if inter.guild else 0, inter.channel.id, inter.user.id,
+                [{"role": "user", "content": message}, {"role": "assistant", "content": reply}],
+            )
+    except AIBusy:
+        await inter.followup.send(AI_BUSY_TEXT)
+    except ModerationFlag:
+        flagged_text = "⚠️ داواکاریەکە بەهۆی یاسای پاراستن ڕەتکرایەوە."
+        if placeholder:
+            await placeholder.edit(content=flagged_text)
+        else:
+            await inter.followup.send(flagged_text)
+    except Exception as e:
+        log.exception("/chat failed: %s", e)
+        error_text = "❌ هەڵەیەک ڕوویدا. تکایە دواتر هەوڵ بدە."
+        if placeholder:
+            await placeholder.edit(content=error_text)
+        else:
+            await inter.followup.send(error_text)
 
 # Context menu: Ask AI about a selected message
 @bot.tree.context_menu(name="Ask Kurdish AI")
 async def ask_ai_context(inter: discord.Interaction, message: discord.Message):
     await inter.response.defer(thinking=True, ephemeral=True)
     content = message.content
-    try:
-        await ai.moderate(content)
-    except ModerationFlag:
-        await inter.followup.send("⚠️ نەتوانرا بپرسرێت لەبەر پاراستن.", ephemeral=True)
-        return
 
-    async with openai_sema:
-        try:
-            hist = await get_history(inter.guild.id if inter.guild else 0, inter.channel.id, inter.user.id)
+    placeholder = None
+    try:
+        with ai_user_limit.hold():
             prompt = f"ئەم پەیامە شرۆڤە بکە و وەڵامێکی بە سود بدە: \n\n{content}"
-            reply = await ai.chat(hist, prompt)
-            hist.append({"role": "user", "content": prompt})
-            hist.append({"role": "assistant", "content": reply})
-            await save_history(inter.guild.id if inter.guild else 0, inter.channel.id, inter.user.id, hist)
-            # Send reply with translation and voice buttons (ephemeral)
-            view = KurdishView(message_content=reply)
-            await inter.followup.send(as_discord_safe(reply), view=view, ephemeral=True)
-        except Exception as e:
-            log.exception("context menu failed: %s", e)
+            # Stream reply with translation and voice buttons (ephemeral)
+            placeholder = await inter.followup.send(STREAM_PLACEHOLDER, ephemeral=True, wait=True)
+            announce_queue(lambda text: placeholder.edit(content=text))
+            if CONTEXT_MENU_STATELESS:
+                # Everyone asking about the same message shares one completion
+                deltas = ai.chat_shared_stream(prompt)
+            else:
+                hist = await get_history(inter.guild.id if inter.guild else 0, inter.channel.id, inter.user.id)
+                deltas = ai.chat_stream(hist, prompt)
+            reply = await stream_to_message(placeholder, moderated_stream(content, deltas))
+            await append_history(
+                inter.guild.id if inter.guild else 0, inter.channel.id, inter.user.id,
+                [{"role": "user", "content": prompt}, {"role": "assistant", "content": reply}],
+            )
+    except AIBusy:
+        await inter.followup.send(AI_BUSY_TEXT, ephemeral=True)
+    except ModerationFlag:
+        if placeholder:
+            await placeholder.edit(content="⚠️ نەتوانرا بپرسرێت لەبەر پاراستن.")
+        else:
+            await inter.followup.send("⚠️ نەتوانرا بپرسرێت لەبەر پاراستن.", ephemeral=True)
+    except Exception as e:
+        log.exception("context menu failed: %s", e)
+        if placeholder:
+            await placeholder.edit(content="❌ هەڵەیەک ڕوویدا.")
+        else:
             await inter.followup.send("❌ هەڵەیەک ڕوویدا.", ephemeral=True)
 
 # /clear to reset memory
@@ -561,6 +2890,42 @@ async def clear_command(inter: discord.Interaction):
 async def ping(inter: discord.Interaction):
     await inter.response.send_message("🏓 pong")
 
+def bot_stats() -> Dict[str, Dict[str, Any]]:
+    """Collect runtime counters shown by /stats."""
+    return {
+        "history_cache": history_cache.stats(),
+        "moderation_cache": moderation_cache.stats(),
+        "translation_cache": {**translation_cache.stats(), **translation_flight.stats()},
+        "tts_cache": tts_cache.stats(),
+        "reply_cache": reply_cache.stats(),
+        "voice_ingest": voice_ingest.stats(),
+        "stt_cache": {**stt_cache.stats(), **stt_flight.stats()},
+        "voice_queue": {
+            "guilds": len(audio_schedulers),
+            "queued": sum(len(x.items) for x in audio_schedulers.values()),
+            "played": sum(x.played for x in audio_schedulers.values()),
+            "deduped": sum(x.deduped for x in audio_schedulers.values()),
+            "dropped": sum(x.dropped for x in audio_schedulers.values()),
+        },
+        "ai": {**ai_registry.stats(), **chat_flight.stats()},
+        "ai_users": ai_user_limit.stats(),
+        **{
+            f"openai_{name}": {**values, **openai_breakers[name].stats()}
+            for name, values in openai_gateway.stats().items()
+        },
+    }
+
+@bot.tree.command(name="stats", description="Show cache and queue statistics (owners only)")
+async def stats_command(inter: discord.Interaction):
+    if inter.user.id not in OWNER_IDS:
+        await inter.response.send_message("⛔ تەنها خاوەنی بۆت.", ephemeral=True)
+        return
+    lines = []
+    for section, values in bot_stats().items():
+        fields = ", ".join(f"{k}={v}" for k, v in values.items())
+        lines.append(f"**{section}**: {fields}")
+    await inter.response.send_message("\n".join(lines)[:1900], ephemeral=True)
+
 # Voice commands
 @bot.tree.command(name="join", description="Join your voice channel")
 async def join_voice(inter: discord.Interaction):
@@ -587,6 +2952,7 @@ async def leave_voice(inter: discord.Interaction):
         return
     
     try:
+        get_audio_scheduler(inter.guild).clear()
         await inter.guild.voice_client.disconnect()
         await inter.followup.send("👋 بۆت کەناڵی دەنگی بەجێهێشت.")
     except Exception as e:
@@ -603,54 +2969,51 @@ async def speak_command(inter: discord.Interaction, message: str):
         return
     
     try:
-        # Generate TTS
-        import time
-        filename = f"tts_{int(time.time())}.mp3"
-        audio_path = await tts_kurdish(message, filename)
-        
-        # Play audio
-        voice_client = inter.guild.voice_client
-        if voice_client.is_playing():
-            voice_client.stop()
-        
-        source = discord.FFmpegPCMAudio(audio_path)
-        voice_client.play(source)
-        
-        await inter.followup.send(f"🗣️ دەنگی کرد: {message[:100]}{'...' if len(message) > 100 else ''}")
-        
-        # Clean up audio file after playing
-        def cleanup(error):
-            if error:
-                log.error(f"Audio playback error: {error}")
-            try:
-                os.remove(audio_path)
-            except:
-                pass
-        
-        source.cleanup = cleanup
+        # Queue TTS playback behind anything already playing in this guild
+        position = queue_speech(inter.guild, message, inter.user.display_name)
+        await inter.followup.send(speech_status(message, position))
         
+    except VoiceQueueFull:
+        await inter.followup.send(VOICE_QUEUE_FULL_TEXT)
     except Exception as e:
         log.exception("TTS command failed: %s", e)
         await inter.followup.send("❌ دەنگکردن سەرکەوتوو نەبوو.")
 
+@bot.tree.command(name="queue", description="Show the voice playback queue")
+async def queue_command(inter: discord.Interaction):
+    if not inter.guild:
+        await inter.response.send_message("❌ تەنها لە سێرڤەردا.", ephemeral=True)
+        return
+    lines = get_audio_scheduler(inter.guild).describe()
+    if not lines:
+        await inter.response.send_message("📭 ڕیزی دەنگ بەتاڵە.", ephemeral=True)
+        return
+    await inter.response.send_message(as_discord_safe("\n".join(lines)), ephemeral=True)
+
 # Prefix fallback: !chat <text>
 @bot.command(name="chat")
 async def legacy_chat(ctx: commands.Context, *, message: str):
     async with ctx.typing():
         try:
-            await ai.moderate(message)
-        except ModerationFlag:
-            await ctx.reply("⚠️ ڕێگە پێنەدرا.")
-            return
-        async with openai_sema:
-            hist = await build_history(ctx)
-            reply = await ai.chat(hist, message)
-            hist.append({"role": "user", "content": message})
-            hist.append({"role": "assistant", "content": reply})
-            await persist_history(ctx, hist)
-            # Send reply with translation and voice buttons
-            view = KurdishView(message_content=reply)
-            await ctx.reply(as_discord_safe(reply), view=view)
+            with ai_user_limit.hold():
+                hist = await build_history(ctx)
+                # Stream reply with translation and voice buttons
+                placeholder = await ctx.reply(STREAM_PLACEHOLDER)
+                announce_queue(lambda text: placeholder.edit(content=text))
+                try:
+                    reply = await stream_to_message(placeholder, moderated_stream(message, ai.answer_stream(hist, message)))
+                except ModerationFlag:
+                    await placeholder.edit(content="⚠️ ڕێگە پێنەدرا.")
+                    return
+                except Exception:
+                    await placeholder.edit(content="❌ هەڵەیەک ڕوویدا.")
+                    raise
+                await persist_history(ctx, [
+                    {"role": "user", "content": message},
+                    {"role": "assistant", "content": reply},
+                ])
+        except AIBusy:
+            await ctx.reply(AI_BUSY_TEXT)
 
 # Streamlined voice commands
 @bot.command(name="join")
@@ -667,6 +3030,7 @@ async def join_voice_legacy(ctx: commands.Context):
 async def leave_voice_legacy(ctx: commands.Context):
     """Bot leaves the voice channel"""
     if ctx.voice_client:
+        get_audio_scheduler(ctx.guild).clear()
         await ctx.voice_client.disconnect()
         await ctx.send("👋 بۆت کەناڵی دەنگی بەجێهێشت.")
     else:
@@ -681,48 +3045,32 @@ async def talk_sorani(ctx: commands.Context, *, message: str):
     
     async with ctx.typing():
         try:
-            # Moderate input
-            await ai.moderate(message)
-            
-            # Get AI reply in Sorani
-            async with openai_sema:
-                reply = await ai_reply_sorani(message)
-                
-                # Generate TTS
-                import time
-                filename = f"sorani_tts_{int(time.time())}.mp3"
-                mp3_path = await tts_sorani(reply, filename)
-                
-                # Play audio
-                if ctx.voice_client.is_playing():
-                    ctx.voice_client.stop()
-                
-                source = discord.FFmpegPCMAudio(mp3_path)
-                ctx.voice_client.play(source)
+            with ai_user_limit.hold():
+                announce_queue(ctx.reply)
+                # Get AI reply in Sorani, gated on moderation of the input
+                # Each sentence is synthesised and played while the rest is still generating
+                reply = await talk_pipeline(
+                    get_audio_scheduler(ctx.guild),
+                    ctx.author.display_name,
+                    moderated_stream(message, ai_reply_sorani_stream(message)),
+                )
                 
                 # Send text response with buttons
                 view = KurdishView(message_content=reply)
                 await ctx.send(f"🗣️ {as_discord_safe(reply)}", view=view)
                 
                 # Save to conversation history
-                hist = await build_history(ctx)
-                hist.append({"role": "user", "content": message})
-                hist.append({"role": "assistant", "content": reply})
-                await persist_history(ctx, hist)
-                
-                # Clean up audio file after playing
-                def cleanup(error):
-                    if error:
-                        log.error(f"Audio playback error: {error}")
-                    try:
-                        os.remove(mp3_path)
-                    except:
-                        pass
-                
-                source.cleanup = cleanup
+                await persist_history(ctx, [
+                    {"role": "user", "content": message},
+                    {"role": "assistant", "content": reply},
+                ])
                 
+        except AIBusy:
+            await ctx.send(AI_BUSY_TEXT)
         except ModerationFlag:
             await ctx.send("⚠️ ڕێگە پێنەدرا.")
+        except VoiceQueueFull:
+            await ctx.send(VOICE_QUEUE_FULL_TEXT)
         except Exception as e:
             log.exception("Talk command failed: %s", e)
             await ctx.send("❌ هەڵەیەک ڕوویدا لە قسەکردندا.")
@@ -741,8 +3089,21 @@ async def main():
             loop.add_signal_handler(s, _handle_sig)
         except NotImplementedError:
             pass
-    async with bot:
-        await bot.start(DISCORD_BOT_TOKEN)
+    await init_db()
+    try:
+        async with bot:
+            bot_task = asyncio.create_task(bot.start(DISCORD_BOT_TOKEN))
+            stop_task = asyncio.create_task(shutdown_event.wait())
+            await asyncio.wait({bot_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+            stop_task.cancel()
+            if not bot_task.done():
+                await bot.close()
+            await bot_task
+    finally:
+        await voice_ingest.close()
+        await history_writer.close()
+        await memory_store.close()
+        await ai_registry.close()
 
 if __name__ == "__main__":
     try: